@@ -1,10 +1,18 @@
 import os
-import subprocess
 import shutil
-import hashlib
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 import threading
+import queue
+import time
+
+from disconverter import jobs, pool
+from disconverter.engine import VIDEO_EXTENSIONS, Engine
+from disconverter.ffmpeg import PAUSE_SUPPORTED
+
+UI_REFRESH_MS = 100  # how often queued worker updates are applied to the widgets
+LOG_MAX_LINES = 1000  # older debug console lines are dropped
+EXIT_WAIT_SECONDS = 10  # how long Exit waits for cancelled encodes to clean up
 
 class VideoCompressorApp:
     def __init__(self, root):
@@ -16,14 +24,26 @@ class VideoCompressorApp:
         self.current_directory = ""
         self.discord_folder = ""
         self.is_running = False
-        self.processed_files = set()
+        self.engine = None
+        self.worker = None
+        self.paused = False
+        self.metrics_file = None  # Prometheus text-format stage metrics, written after each video
+        self.scratch_dir = None  # Intermediates, e.g. on a fast local disk (None: the system temp folder)
+        self.tiers = None  # Size caps in MB for a ladder of copies, e.g. (10, 25, 50, 500) (None: 10MB only)
+        self.redo = False
         self.reencoded_files = []
-        self.video_extensions = (".mp4", ".mkv", ".avi", ".mov", ".wmv", ".flv")
         self.total_files = 0
         self.video_files = 0
         self.processed_count = 0
         self.current_file = ""
         self.show_debug = False
+        self.active_files = []
+        self.fused = True  # Encode the master and the Discord copy from one decode
+        self.chunked = True  # Encode long videos as parallel keyframe-aligned segments
+        self.ui_queue = queue.Queue()
+        self.state_lock = threading.Lock()
+        self.file_progress = {}
+        self.batch_start = 0.0
         
         # Try to read paths from file first
         self.read_paths_from_file()
@@ -31,6 +51,12 @@ class VideoCompressorApp:
         # UI Elements
         self.create_widgets()
         
+        # Worker threads never touch widgets, their updates are queued instead
+        self.root.after(UI_REFRESH_MS, self.poll_ui)
+        
+        # Closing the window stops ffmpeg too
+        self.root.protocol("WM_DELETE_WINDOW", self.exit_app)
+        
         # Check ffmpeg
         if shutil.which("ffmpeg") is None:
             messagebox.showerror("Error", "ffmpeg is not installed. Please install it first.")
@@ -104,6 +130,10 @@ class VideoCompressorApp:
         self.status_label = ttk.Label(progress_frame, text="Status: Ready", font=('Helvetica', 10, 'bold'))
         self.status_label.pack(fill=tk.X, pady=5)
         
+        # Encode speed and ETA
+        self.progress_label = ttk.Label(progress_frame, text="")
+        self.progress_label.pack(fill=tk.X, pady=5)
+        
         # Progress counter
         self.counter_label = ttk.Label(progress_frame, 
                                      text="0/0 files processed (0 videos found)")
@@ -140,7 +170,30 @@ class VideoCompressorApp:
                                     command=self.redo_processing, state=tk.DISABLED)
         self.redo_button.pack(side=tk.LEFT, padx=15, pady=5)
         
-        ttk.Button(control_frame, text="Exit", command=self.root.quit).pack(side=tk.RIGHT, padx=15, pady=5)
+        # Stop cancels the running encodes, they resume on the next start
+        self.stop_button = ttk.Button(control_frame, text="Stop", 
+                                    command=self.stop_processing, state=tk.DISABLED)
+        self.stop_button.pack(side=tk.LEFT, padx=15, pady=5)
+        
+        # Pausing stops ffmpeg with a signal, which Windows doesn't have
+        self.pause_button = ttk.Button(control_frame, text="Pause", 
+                                     command=self.toggle_pause, state=tk.DISABLED)
+        if PAUSE_SUPPORTED:
+            self.pause_button.pack(side=tk.LEFT, padx=15, pady=5)
+        
+        # Parallel jobs, the cores are split between them
+        ttk.Label(control_frame, text="Parallel jobs:").pack(side=tk.LEFT, padx=(15, 5), pady=5)
+        self.jobs_var = tk.IntVar(value=pool.default_jobs())
+        ttk.Spinbox(control_frame, from_=1, to=os.cpu_count() or 1, width=4,
+                    textvariable=self.jobs_var).pack(side=tk.LEFT, pady=5)
+        
+        # Processing order of the batch
+        ttk.Label(control_frame, text="Order:").pack(side=tk.LEFT, padx=(15, 5), pady=5)
+        self.order_var = tk.StringVar(value="shortest")
+        ttk.Combobox(control_frame, values=jobs.ORDERS, width=9, state="readonly",
+                     textvariable=self.order_var).pack(side=tk.LEFT, pady=5)
+        
+        ttk.Button(control_frame, text="Exit", command=self.exit_app).pack(side=tk.RIGHT, padx=15, pady=5)
     
     def toggle_debug(self):
         """Toggle debug console visibility"""
@@ -156,8 +209,7 @@ class VideoCompressorApp:
     
     def update_status(self, message):
         """Update the main status label"""
-        self.status_label.config(text=f"Status: {message}")
-        self.root.update()
+        self.ui_queue.put(("status", message))
     
     def set_source_dir(self):
         directory = filedialog.askdirectory()
@@ -173,7 +225,7 @@ class VideoCompressorApp:
             self.output_dir_label.config(text=f"Output: {directory}")
             self.save_paths_to_file()
     
-    def start_processing(self):
+    def start_processing(self, redo=False):
         if not self.current_directory or not self.discord_folder:
             messagebox.showwarning("Warning", "Please set both source and output directories")
             return
@@ -182,195 +234,231 @@ class VideoCompressorApp:
             return
             
         self.is_running = True
+        self.redo = redo
         self.start_button.config(state=tk.DISABLED)
         self.redo_button.config(state=tk.DISABLED)
+        self.stop_button.config(state=tk.NORMAL)
+        self.pause_button.config(state=tk.NORMAL, text="Pause")
+        self.paused = False
         self.processed_count = 0
         self.reencoded_files = []
+        self.active_files = []
+        self.file_progress = {}
+        self.batch_start = time.monotonic()
+        try:
+            self.jobs = max(1, self.jobs_var.get())
+        except tk.TclError:
+            self.jobs = 1
+        self.order = self.order_var.get()
         
         # Clear log and reset UI
         self.log_text.config(state=tk.NORMAL)
         self.log_text.delete(1.0, tk.END)
         self.log_text.config(state=tk.DISABLED)
         self.progress_bar["value"] = 0
+        self.progress_label.config(text="")
         self.current_file_label.config(text="Current file: None")
         
         # Start processing
-        threading.Thread(target=self.process_videos, daemon=True).start()
+        self.worker = threading.Thread(target=self.process_videos, daemon=True)
+        self.worker.start()
     
     def redo_processing(self):
-        """Simply restart the processing without clearing anything"""
-        self.start_processing()
+        """Run again, recreating missing Discord copies of processed videos, from the cache where possible"""
+        self.start_processing(redo=True)
+    
+    def stop_processing(self):
+        """Cancel the running encodes and skip the rest of the batch"""
+        if self.is_running and self.engine is not None:
+            self.engine.cancel()
+            self.stop_button.config(state=tk.DISABLED)
+            self.pause_button.config(state=tk.DISABLED)
+            self.update_status("Stopping")
+    
+    def toggle_pause(self):
+        """Pause or resume the running encodes"""
+        if not self.is_running or self.engine is None:
+            return
+        if self.paused:
+            self.engine.resume()
+            self.pause_button.config(text="Pause")
+            self.update_status("Resumed")
+        else:
+            self.engine.pause()
+            self.pause_button.config(text="Resume")
+            self.update_status("Paused")
+        self.paused = not self.paused
+    
+    def exit_app(self):
+        """Stop ffmpeg and let the workers remove their temp files before quitting"""
+        if self.is_running and self.engine is not None:
+            self.engine.cancel()
+            self.worker.join(EXIT_WAIT_SECONDS)
+        self.root.quit()
     
     def update_counter(self):
         """Update the counter label with current progress"""
-        self.counter_label.config(
-            text=f"{self.processed_count}/{self.video_files} files processed ({self.video_files} videos found)"
-        )
-        self.root.update()
+        self.ui_queue.put(("counter", None))
+    
+    def update_current_files(self):
+        """Show every file that is being worked on right now"""
+        self.ui_queue.put(("current", None))
+    
+    def poll_ui(self):
+        """Apply the queued worker updates to the widgets, once per UI frame"""
+        status = None
+        lines = []
+        refresh_counter = refresh_current = complete = False
+        try:
+            while True:
+                kind, value = self.ui_queue.get_nowait()
+                if kind == "status":
+                    status = value
+                elif kind == "log":
+                    lines.append(value)
+                elif kind == "counter":
+                    refresh_counter = True
+                elif kind == "current":
+                    refresh_current = True
+                elif kind == "complete":
+                    complete = True
+        except queue.Empty:
+            pass
+        
+        if status is not None:
+            self.status_label.config(text=f"Status: {status}")
+        if lines:
+            self.append_log(lines)
+        if refresh_counter:
+            self.counter_label.config(
+                text=f"{self.processed_count}/{self.video_files} files processed ({self.video_files} videos found)"
+            )
+        if refresh_current:
+            with self.state_lock:
+                current = ", ".join(self.active_files) or "None"
+            self.current_file_label.config(text=f"Current file: {current}")
+        if self.is_running:
+            self.update_progress()
+        if complete:
+            self.processing_complete()
+        
+        self.root.after(UI_REFRESH_MS, self.poll_ui)
+    
+    def update_progress(self):
+        """Show batch progress including the running encodes, their speed and the ETA"""
+        with self.state_lock:
+            done = self.processed_count
+            running = list(self.file_progress.values())
+        completed = done + sum(p["fraction"] for p in running)
+        self.progress_bar["maximum"] = max(self.video_files, 1)
+        self.progress_bar["value"] = completed
+        
+        details = []
+        if running:
+            details.append(f"{sum(p['fps'] for p in running):.0f} fps")
+            details.append(f"{sum(p['speed'] for p in running):.2f}x")
+        if completed > 0 and self.video_files:
+            elapsed = time.monotonic() - self.batch_start
+            remaining = int(elapsed * (self.video_files - completed) / completed)
+            details.append(f"ETA {remaining // 3600:d}:{remaining // 60 % 60:02d}:{remaining % 60:02d}")
+        self.progress_label.config(text=" · ".join(details))
     
     def process_videos(self):
         self.update_status("Initializing")
         self.debug_message("Initializing...")
-        self.processed_files = self.load_processed_files()
+        self.engine = Engine(self.discord_folder, jobs=self.jobs, on_event=self.engine_event, fused=self.fused,
+                             chunked=self.chunked, order=self.order, redo=self.redo,
+                             scratch_dir=self.scratch_dir, tiers=self.tiers, metrics_file=self.metrics_file)
         
         self.update_status("Checking files")
-        self.debug_message(f"Video extensions: {self.video_extensions}")
+        self.debug_message(f"Video extensions: {VIDEO_EXTENSIONS}")
         self.debug_message(f"Checking all files within: {self.current_directory}")
         
         # Count files first for progress
-        file_list = os.listdir(self.current_directory)
-        self.total_files = len(file_list)
-        self.video_files = sum(1 for f in file_list if f.lower().endswith(self.video_extensions))
+        self.total_files = len(os.listdir(self.current_directory))
+        video_paths = self.engine.scan(self.current_directory)
+        self.video_files = len(video_paths)
         self.update_counter()
         
         if self.video_files == 0:
             self.update_status("Ready (no videos found)")
             self.debug_message("No video files found!")
-            self.processing_complete()
+            self.engine.close()
+            self.ui_queue.put(("complete", None))
             return
-            
-        self.progress_bar["maximum"] = self.video_files
-        
-        # Process files
-        for filename in os.listdir(self.current_directory):
-            if not self.is_running:  # Allow stopping if needed
-                break
-                
-            if filename.lower().endswith(self.video_extensions):
-                self.current_file = filename
-                self.current_file_label.config(text=f"Current file: {filename}")
-                file_path = os.path.join(self.current_directory, filename)
-                
-                self.reencode_video(file_path)
-                self.processed_count += 1
-                self.progress_bar["value"] = self.processed_count
-                self.update_counter()
-                self.root.update()
-        
-        self.update_status("Complete")
-        self.debug_message(f"\nProcessing complete: {self.video_files} video files processed")
+        
+        # Interrupted jobs resume first, is_running allows stopping between files
+        self.debug_message(f"Parallel jobs: {self.jobs}, order: {self.order}")
+        results = self.engine.run(video_paths, should_continue=lambda: self.is_running, on_done=self.file_done)
+        self.reencoded_files = [os.path.basename(result.path) for result in results if result.reencoded]
+        
+        if self.engine.cancelled:
+            self.update_status("Stopped")
+            self.debug_message("\nStopped, unfinished videos resume on the next start")
+        else:
+            self.update_status("Complete")
+            self.debug_message(f"\nProcessing complete: {self.video_files} video files processed")
         
         if self.reencoded_files:
             self.debug_message("\nRe-encoded files:")
             for file in self.reencoded_files:
                 self.debug_message(file)
         
-        self.processing_complete()
+        self.engine.close()
+        self.debug_message("")
+        for line in self.engine.summary():
+            self.debug_message(line)
+        self.ui_queue.put(("complete", None))
+    
+    def engine_event(self, event):
+        """Route the engine's events from the worker threads to the widgets"""
+        filename = os.path.basename(event.path) if event.path else None
+        if event.kind == "status":
+            self.update_status(event.message)
+        elif event.kind == "log":
+            self.debug_message(event.message)
+        elif event.kind == "started":
+            with self.state_lock:
+                self.current_file = filename
+                self.active_files.append(filename)
+            self.update_current_files()
+        elif event.kind == "progress":
+            with self.state_lock:
+                self.file_progress[filename] = event.data
+        elif event.kind in ("done", "failed", "cancelled"):
+            with self.state_lock:
+                self.active_files.remove(filename)
+                self.file_progress.pop(filename, None)
+            self.update_current_files()
+    
+    def file_done(self, file_path, done_count):
+        with self.state_lock:
+            self.processed_count = done_count
+        self.update_counter()
     
     def processing_complete(self):
         self.is_running = False
         self.start_button.config(state=tk.NORMAL)
         self.redo_button.config(state=tk.NORMAL)
+        self.stop_button.config(state=tk.DISABLED)
+        self.pause_button.config(state=tk.DISABLED, text="Pause")
         self.current_file_label.config(text="Current file: None")
+        self.progress_bar["value"] = self.processed_count
+        self.progress_label.config(text="")
     
     def debug_message(self, message):
         """Add message to debug console only"""
+        self.ui_queue.put(("log", message))
+    
+    def append_log(self, lines):
+        """Write queued lines to the debug console, keeping only the last LOG_MAX_LINES"""
         self.log_text.config(state=tk.NORMAL)
-        self.log_text.insert(tk.END, message + "\n")
+        self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+        line_count = int(self.log_text.index("end-1c").split(".")[0]) - 1
+        if line_count > LOG_MAX_LINES:
+            self.log_text.delete("1.0", f"{line_count - LOG_MAX_LINES + 1}.0")
         self.log_text.see(tk.END)
         self.log_text.config(state=tk.DISABLED)
-        self.root.update()
-    
-    def load_processed_files(self):
-        if os.path.exists("processed_videos.txt"):
-            with open("processed_videos.txt", "r") as f:
-                return {line.strip() for line in f}
-        return set()
-    
-    def generate_file_hash(self, file_path):
-        self.update_status("Checking file/hash...")
-        hasher = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            while chunk := f.read(8192):
-                hasher.update(chunk)
-        return hasher.hexdigest()
-    
-    def save_processed_file(self, file_hash):
-        self.update_status("Writing hash")
-        with open("processed_videos.txt", "a") as f:
-            f.write(file_hash + "\n")
-    
-    def get_video_codec(self, file_path):
-        cmd = [
-            "ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=codec_name", 
-            "-of", "default=noprint_wrappers=1:nokey=1", file_path
-        ]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        return result.stdout.strip()
-    
-    def compress_video(self, input_file, output_file, max_size_mb=10):
-        crf = 28
-        min_crf = 18
-        max_crf = 51
-        
-        while crf <= max_crf:
-            cmd = [
-                "ffmpeg", "-i", input_file,
-                "-c:v", "libx264",
-                "-preset", "slow",
-                "-crf", str(crf),
-                "-c:a", "aac",
-                "-b:a", "128k",
-                output_file
-            ]
-            
-            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            
-            if os.path.exists(output_file):
-                file_size_mb = os.path.getsize(output_file) / (1024 * 1024)
-                
-                if file_size_mb <= max_size_mb:
-                    return True
-                else:
-                    crf += 2
-                    os.remove(output_file)
-            else:
-                self.debug_message("Error: Output file not created")
-                return False
-        
-        return False
-    
-    def reencode_video(self, file_path):
-        file_hash = self.generate_file_hash(file_path)
-        if file_hash in self.processed_files:
-            return
-        
-        original_codec = self.get_video_codec(file_path)
-        self.update_status(f"Checking: {os.path.basename(file_path)}")
-        self.debug_message(f"Processing: {os.path.basename(file_path)} (Codec: {original_codec})")
-        
-        if original_codec == "h264":
-            self.save_processed_file(file_hash)
-            self.debug_message(f"Skipping (already H.264): {os.path.basename(file_path)}\n")
-            return
-        
-        temp_file = f"{file_path}.temp.mp4"
-        self.update_status(f"Converting: {os.path.basename(file_path)}")
-        self.debug_message(f"Re-encoding to H.264: {os.path.basename(file_path)}")
-        
-        cmd = [
-            "ffmpeg", "-i", file_path, "-c:v", "libx264", "-preset", "slow", 
-            "-crf", "18", "-c:a", "aac", "-b:a", "128k", temp_file
-        ]
-        
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        
-        if os.path.exists(temp_file):
-            os.replace(temp_file, file_path)
-            self.reencoded_files.append(os.path.basename(file_path))
-            self.save_processed_file(file_hash)
-        
-        # Create Discord version if needed
-        if os.path.getsize(file_path) > 10 * 1024 * 1024:
-            os.makedirs(self.discord_folder, exist_ok=True)
-            discord_file = os.path.join(self.discord_folder, "shrunk_" + os.path.basename(file_path))
-            self.update_status(f"Compressing: {os.path.basename(file_path)}")
-            self.debug_message(f"Compressing for Discord: {os.path.basename(file_path)}")
-            
-            if self.compress_video(file_path, discord_file, max_size_mb=10):
-                self.debug_message(f"Created: {os.path.basename(discord_file)} ({os.path.getsize(discord_file) / (1024 * 1024):.2f} MB)\n")
-            else:
-                self.debug_message(f"Failed to compress: {os.path.basename(file_path)}\n")
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1 @@
+"""Shared video handling used by the GUI and the command line, see engine.py."""
@@ -0,0 +1,207 @@
+"""Benchmarks the conversion pipeline on a generated, reproducible corpus.
+
+    python -m disconverter.bench [--corpus DIR] [--output FILE] [--baseline FILE]
+
+The corpus is built with ffmpeg's lavfi sources, so every run encodes the same
+frames. Each clip is copied to a scratch folder and run through the light
+engine, recording wall time, child CPU time, the ffmpeg runs
+by kind, the final size and whether it ended up under the cap as a whole,
+playable video of the clip's length. Results are
+written as JSON and can be compared against an earlier run with --baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+from .engine import Engine
+from .ffmpeg import run_listener
+from .probe import is_complete, run_probe
+
+MAX_SIZE_MB = 10
+
+# name, lavfi video source, encoder, extension, duration in seconds
+CORPUS = [
+    ("testsrc2_h264_720p", "testsrc2=size=1280x720:rate=30", "libx264", ".mp4", 30),
+    ("testsrc2_h264_1080p_long", "testsrc2=size=1920x1080:rate=30", "libx264", ".mp4", 120),
+    ("mandelbrot_hevc_1080p", "mandelbrot=size=1920x1080:rate=30", "libx265", ".mkv", 20),
+    ("testsrc2_vp9_480p", "testsrc2=size=854x480:rate=30", "libvpx-vp9", ".mkv", 60),
+    ("testsrc2_mpeg4_720p", "testsrc2=size=1280x720:rate=25", "mpeg4", ".avi", 45),
+    # Per-frame noise barely compresses, these are the hard cases
+    ("noise_hevc_720p", "testsrc2=size=1280x720:rate=30,noise=alls=60:allf=t+u:all_seed=1234", "libx265", ".mkv", 30),
+    ("noise_mpeg4_1080p", "testsrc2=size=1920x1080:rate=30,noise=alls=80:allf=t+u:all_seed=4321", "mpeg4", ".avi", 60),
+]
+
+# Source bitrates high enough that every clip starts out over the cap
+SOURCE_ARGS = {
+    "libx264": ["-crf", "12", "-preset", "veryfast"],
+    "libx265": ["-crf", "14", "-preset", "fast"],
+    "libvpx-vp9": ["-b:v", "4M", "-deadline", "realtime", "-cpu-used", "8"],
+    "mpeg4": ["-q:v", "2"],
+}
+
+
+def available_encoders():
+    result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return {line.split()[1] for line in result.stdout.splitlines()[1:] if len(line.split()) > 1}
+
+
+def build_corpus(corpus_dir):
+    """Generates any missing corpus clips. Returns their paths, skipping unavailable encoders."""
+    os.makedirs(corpus_dir, exist_ok=True)
+    encoders = available_encoders()
+    clips = []
+    for name, source, encoder, ext, duration in CORPUS:
+        if encoder not in encoders:
+            print(f"Skipping {name}: ffmpeg has no {encoder} encoder")
+            continue
+        path = os.path.join(corpus_dir, name + ext)
+        if not os.path.exists(path):
+            print(f"Generating {name}...")
+            subprocess.run([
+                "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+                "-f", "lavfi", "-i", source,
+                "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000",
+                "-t", str(duration), "-c:v", encoder, *SOURCE_ARGS[encoder],
+                "-c:a", "ac3" if ext == ".avi" else "aac", "-b:a", "192k", path
+            ], check=True)
+        clips.append(path)
+    return clips
+
+
+def run_kind(cmd):
+    """Classifies an ffmpeg run as a sample, an analysis pass, a full encode or other work.
+
+    Only libx264 runs at a CRF or bitrate are encodes; splitting, joining,
+    audio and remux runs count as "other".
+    """
+    if "null" in cmd:
+        return "analysis"
+    if "libx264" not in cmd or ("-crf" not in cmd and "-b:v" not in cmd):
+        return "other"
+    if "-t" in cmd:
+        return "sample"
+    return "full"
+
+
+def bench_clip(clip, work_dir):
+    """Runs one clip through the pipeline in work_dir and returns its measurements."""
+    name = os.path.basename(clip)
+    source_dir = os.path.join(work_dir, "source")
+    output_dir = os.path.join(work_dir, "output")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(source_dir)
+    file_path = os.path.join(source_dir, name)
+    shutil.copyfile(clip, file_path)
+    input_bytes = os.path.getsize(file_path)
+    source = run_probe(file_path)
+
+    # A fresh index and no output cache, so every run really encodes
+    engine = Engine(output_dir, MAX_SIZE_MB, cache=False, db_path=os.path.join(work_dir, "index.db"),
+                    legacy_path=os.path.join(work_dir, "none.txt"), events_path=None)
+    runs = {"sample": 0, "analysis": 0, "full": 0, "other": 0}
+
+    def count(cmd, returncode, seconds):
+        runs[run_kind(cmd)] += 1
+
+    times = os.times()
+    started = time.perf_counter()
+    with run_listener(count):
+        engine.process(file_path)
+    wall = time.perf_counter() - started
+    after = os.times()
+    engine.close()
+
+    shrunk = [os.path.join(output_dir, f) for f in os.listdir(output_dir)] if os.path.isdir(output_dir) else []
+    final_file = shrunk[0] if shrunk else file_path
+    final_bytes = os.path.getsize(final_file)
+    # An empty, truncated or unreadable result is a miss however small it is
+    valid = final_bytes > 0 and is_complete(final_file, source.duration if source else None)
+    return {
+        "name": name,
+        "input_bytes": input_bytes,
+        "wall_s": round(wall, 3),
+        "child_cpu_s": round((after.children_user - times.children_user)
+                             + (after.children_system - times.children_system), 3),
+        "ffmpeg_runs": runs,
+        "encode_attempts": runs["full"],
+        "final_bytes": final_bytes,
+        "valid": valid,
+        "under_cap": valid and final_bytes <= MAX_SIZE_MB * 1024 * 1024,
+    }
+
+
+def summarize(results):
+    count = len(results) or 1
+    return {
+        "clips": len(results),
+        "wall_s": round(sum(r["wall_s"] for r in results), 3),
+        "child_cpu_s": round(sum(r["child_cpu_s"] for r in results), 3),
+        "encode_attempts": sum(r["encode_attempts"] for r in results),
+        "hit_rate": round(sum(r["under_cap"] for r in results) / count, 3),
+    }
+
+
+def compare(current, baseline):
+    """Prints per-clip and total wall time against a baseline result file."""
+    before = {r["name"]: r for r in baseline["results"]}
+    print(f"\n{'clip':<36}{'wall':>10}{'baseline':>10}{'ratio':>8}")
+    for r in current["results"]:
+        old = before.get(r["name"])
+        if old:
+            ratio = r["wall_s"] / old["wall_s"] if old["wall_s"] else float("nan")
+            print(f"{r['name']:<36}{r['wall_s']:>10.1f}{old['wall_s']:>10.1f}{ratio:>8.2f}")
+    now, then = current["summary"], baseline["summary"]
+    print(f"\nTotal wall {now['wall_s']:.1f}s vs {then['wall_s']:.1f}s, "
+          f"child CPU {now['child_cpu_s']:.1f}s vs {then['child_cpu_s']:.1f}s, "
+          f"hit rate {now['hit_rate']:.0%} vs {then['hit_rate']:.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Disconverter pipeline.")
+    parser.add_argument("--corpus", default="bench_corpus", help="where the generated clips are kept")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    parser.add_argument("--only", help="only run clips whose name contains this")
+    args = parser.parse_args()
+
+    clips = build_corpus(args.corpus)
+    if args.only:
+        clips = [c for c in clips if args.only in os.path.basename(c)]
+    work_dir = tempfile.mkdtemp(prefix="disconvert_bench_")
+    results = []
+    try:
+        for clip in clips:
+            print(f"Running {os.path.basename(clip)}...")
+            results.append(bench_clip(clip, os.path.join(work_dir, "clip")))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    version = subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, text=True).stdout.split("\n")[0]
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "ffmpeg": version,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+        "summary": summarize(results),
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["summary"], indent=2))
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Picks the x264 preset of each job so a batch keeps to a time budget.
+
+The budget is either a deadline for the whole queue or a realtime factor it
+should keep up, in seconds of video per second. Every finished encode
+measures how fast a job runs, normalised to what it would have taken at
+slow; the next job then gets the slowest preset that still finishes what is
+left of the queue in time. Without a budget every output is encoded at slow.
+Search and trial encodes, like the planner's samples, always run at a fast
+preset, only the outputs that are kept pay for the slow one.
+"""
+import threading
+import time
+
+PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow")
+DEFAULT_PRESET = "slow"
+SEARCH_PRESET = "veryfast"
+FIRST_PRESET = "medium"  # until the first encode has measured the machine
+SMOOTHING = 0.3  # weight of the newest measurement in the running speed
+
+# Encode time of each preset relative to slow, rough x264 figures
+COST = {
+    "ultrafast": 0.08,
+    "superfast": 0.12,
+    "veryfast": 0.2,
+    "faster": 0.35,
+    "fast": 0.45,
+    "medium": 0.6,
+    "slow": 1.0,
+}
+
+
+def search_preset(preset=DEFAULT_PRESET):
+    """Returns the preset for throwaway encodes: SEARCH_PRESET, or preset if that is faster still."""
+    return min(SEARCH_PRESET, preset, key=PRESETS.index)
+
+
+class Budget:
+    """Chooses presets from the measured speed and what is left of the queue, safe to share between threads.
+
+    deadline is a time.time() by which the queue should be done, speed the
+    realtime factor the whole batch should keep; give one of them. jobs is
+    how many files run at once, each has to do its share.
+    """
+
+    def __init__(self, deadline=None, speed=None, jobs=1):
+        self.deadline = deadline
+        self.speed = speed
+        self.jobs = max(1, jobs)
+        self.lock = threading.Lock()
+        self.remaining = {}  # file path -> seconds of video still to do
+        self.rate = None  # seconds of video per second one job manages at slow
+
+    def add(self, file_path, duration):
+        """Counts a queued file towards the work left."""
+        if duration:
+            with self.lock:
+                self.remaining[file_path] = duration
+
+    def required_speed(self):
+        """Returns the realtime factor each job has to keep for the batch to finish in time."""
+        with self.lock:
+            left = sum(self.remaining.values())
+        if self.deadline is None:
+            return self.speed / self.jobs
+        seconds = self.deadline - time.time()
+        if seconds <= 0:
+            return float("inf")
+        return left / seconds / self.jobs
+
+    def expected_speed(self, preset):
+        """Returns the realtime factor a job is expected to reach at preset, or None before any measurement."""
+        with self.lock:
+            rate = self.rate
+        return rate / COST[preset] if rate else None
+
+    def pick(self):
+        """Returns the slowest preset expected to keep the budget, the fastest one if none does."""
+        if self.expected_speed(DEFAULT_PRESET) is None:
+            return FIRST_PRESET
+        needed = self.required_speed()
+        for preset in reversed(PRESETS):
+            if self.expected_speed(preset) >= needed:
+                return preset
+        return PRESETS[0]
+
+    def describe(self, preset):
+        """Returns why preset was picked, for the log."""
+        needed = self.required_speed()
+        if needed == float("inf"):
+            return f"{preset}, the deadline has passed"
+        expected = self.expected_speed(preset)
+        if expected is None:
+            return f"{preset}, {needed:.2f}x realtime needed per job, speed not measured yet"
+        return f"{preset}, {needed:.2f}x realtime needed per job, about {expected:.2f}x expected"
+
+    def finish(self, file_path, preset=None, seconds=None):
+        """Takes a file off the work left; with preset and seconds its encode time is measured too."""
+        with self.lock:
+            duration = self.remaining.pop(file_path, None)
+            if not duration or not preset or not seconds:
+                return
+            rate = duration * COST[preset] / seconds
+            self.rate = rate if self.rate is None else self.rate + SMOOTHING * (rate - self.rate)
@@ -0,0 +1,134 @@
+"""Content-addressed cache of finished Discord copies.
+
+Copies are stored under a key built from the fingerprint of the file they were
+made from, the encode settings, the x264 preset and the size cap, so the same
+content is never compressed twice for the same target, whatever it is called,
+and a copy rushed out at a fast preset isn't passed off as a slow one. Hits are hard
+linked into the output folder where the filesystem allows it, copied where it
+doesn't. The least recently used copies are evicted once the cache outgrows
+its size limit. Only non-empty copies under their cap are stored, and an
+entry whose file is gone, empty or a different size than stored is dropped
+on the next lookup.
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from . import planner, target
+from .budget import DEFAULT_PRESET
+from .compress import MASTER_CRF
+from .index import DB_PATH
+
+CACHE_DIR = "output_cache"
+MAX_CACHE_MB = 1024
+SETTINGS_VERSION = 2  # bump when an encode change makes old copies stale
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+"""
+
+
+def settings_key():
+    """Returns a string that changes whenever the encode settings do."""
+    return ":".join(str(value) for value in (
+        SETTINGS_VERSION, MASTER_CRF, target.AUDIO_BITRATE_KBPS, target.MIN_BITS_PER_PIXEL,
+        target.MAX_FPS, planner.SAFETY,
+    ))
+
+
+def cache_key(fingerprint, max_size_mb, preset=DEFAULT_PRESET):
+    return hashlib.blake2b(f"{fingerprint}|{settings_key()}|{preset}|{max_size_mb}".encode(),
+                           digest_size=16).hexdigest()
+
+
+def link_or_copy(source, destination):
+    """Hard links source to destination, falling back to a copy across filesystems."""
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def valid_copy(path, max_size_mb, size=None):
+    """Returns True if path is a non-empty file under the cap, of the given size if one is passed."""
+    if not os.path.exists(path):
+        return False
+    actual = os.path.getsize(path)
+    return 0 < actual <= max_size_mb * 1024 * 1024 and (size is None or actual == size)
+
+
+class OutputCache:
+    """Size-bounded LRU cache of Discord copies, safe to share between threads."""
+
+    def __init__(self, db_path=DB_PATH, cache_dir=CACHE_DIR, max_mb=MAX_CACHE_MB):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".mp4")
+
+    def fetch(self, fingerprint, max_size_mb, output_file, preset=DEFAULT_PRESET):
+        """Puts the copy cached for preset at output_file. Returns False on a miss."""
+        key = cache_key(fingerprint, max_size_mb, preset)
+        with self.lock:
+            row = self.conn.execute("SELECT size FROM outputs WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return False
+            if not valid_copy(self.path(key), max_size_mb, row[0]):
+                if os.path.exists(self.path(key)):
+                    os.remove(self.path(key))
+                self.conn.execute("DELETE FROM outputs WHERE key = ?", (key,))
+                self.conn.commit()
+                return False
+            self.conn.execute("UPDATE outputs SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            link_or_copy(self.path(key), output_file)
+        return True
+
+    def store(self, fingerprint, max_size_mb, output_file, preset=DEFAULT_PRESET):
+        """Adds a copy encoded at preset to the cache and evicts old ones if it grew too big.
+
+        Empty or oversize files are not stored.
+        """
+        if not valid_copy(output_file, max_size_mb):
+            return
+        key = cache_key(fingerprint, max_size_mb, preset)
+        with self.lock:
+            link_or_copy(output_file, self.path(key))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO outputs (key, size, last_used) VALUES (?, ?, ?)",
+                (key, os.path.getsize(output_file), time.time())
+            )
+            self.conn.commit()
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used copies until the cache fits max_bytes. Call with the lock held."""
+        rows = self.conn.execute("SELECT key, size FROM outputs ORDER BY last_used DESC").fetchall()
+        total = 0
+        for key, size in rows:
+            total += size
+            if total > self.max_bytes:
+                if os.path.exists(self.path(key)):
+                    os.remove(self.path(key))
+                self.conn.execute("DELETE FROM outputs WHERE key = ?", (key,))
+        self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
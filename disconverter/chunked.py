@@ -0,0 +1,119 @@
+"""Encodes one long video as keyframe-aligned segments in parallel.
+
+A single x264 process stops scaling well past a handful of threads, so long
+sources are cut at keyframes with the segment muxer (no re-encode), the
+segments are encoded side by side at the same settings, and the results are
+joined with the concat demuxer and the separately encoded audio. The joined
+file's duration and audio/video sync are checked before it is accepted.
+"""
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics, scratch
+from .ffmpeg import controlled, current_control, output_ok, run_ffmpeg
+from .probe import run_probe
+
+MIN_DURATION = 600  # shorter videos aren't worth splitting
+SEGMENT_SECONDS = 60
+CHUNK_THREADS = 4  # x264 threads per segment encode
+DURATION_TOLERANCE = 0.5  # seconds the joined file may differ from the source
+SYNC_TOLERANCE = 0.2  # seconds audio and video may differ in the joined file
+
+
+def applies(duration):
+    """Returns True if a video of this duration should be encoded in chunks."""
+    return bool(duration) and duration >= MIN_DURATION
+
+
+def split(input_file, work_dir):
+    """Cuts the video stream at keyframes. Returns the segment paths in order, none if ffmpeg failed."""
+    pattern = os.path.join(work_dir, "source_%04d.mkv")
+    returncode = run_ffmpeg([
+        "-i", input_file, "-map", "0:v:0", "-c", "copy",
+        "-f", "segment", "-segment_time", str(SEGMENT_SECONDS), "-reset_timestamps", "1", pattern
+    ])
+    if returncode != 0:
+        return []
+    return sorted(
+        os.path.join(work_dir, name) for name in os.listdir(work_dir)
+        if name.startswith("source_") and name.endswith(".mkv")
+    )
+
+
+def encode_audio(input_file, work_dir, audio_args):
+    """Encodes the audio track on its own. Returns its path, or None if there is no audio."""
+    audio_file = os.path.join(work_dir, "audio.m4a")
+    returncode = run_ffmpeg(["-i", input_file, "-vn", "-map", "0:a:0?", *audio_args, audio_file])
+    return audio_file if output_ok(returncode, audio_file) else None
+
+
+def concat(segments, audio_file, output_file, work_dir):
+    """Joins the encoded segments and the audio without re-encoding."""
+    list_file = os.path.join(work_dir, "segments.txt")
+    with open(list_file, "w") as f:
+        for segment in segments:
+            escaped = segment.replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    args = ["-f", "concat", "-safe", "0", "-i", list_file]
+    if audio_file:
+        args += ["-i", audio_file, "-map", "0:v:0", "-map", "1:a:0"]
+    return output_ok(run_ffmpeg([*args, "-c", "copy", "-movflags", "+faststart", output_file]), output_file)
+
+
+def verify(output_file, duration, log=print):
+    """Checks the joined file against the source duration and its own A/V sync."""
+    info = run_probe(output_file)
+    if info is None or info.video is None:
+        log("Chunked: joined file can't be read")
+        return False
+    if duration and info.duration and abs(info.duration - duration) > DURATION_TOLERANCE:
+        log(f"Chunked: joined duration {info.duration:.2f}s doesn't match the source ({duration:.2f}s)")
+        return False
+    video, audio = info.video, info.audio
+    if audio and video.duration and audio.duration and abs(video.duration - audio.duration) > SYNC_TOLERANCE:
+        log(f"Chunked: audio and video drift apart ({audio.duration:.2f}s vs {video.duration:.2f}s)")
+        return False
+    return True
+
+
+def encode_chunked(input_file, output_file, encode_segment, audio_args, duration=None, threads=None, log=print):
+    """Encodes input_file in parallel segments with encode_segment(source, output, threads).
+
+    encode_segment returns ffmpeg's exit code. threads is the core budget for the whole file; it is split into segment
+    encodes of CHUNK_THREADS threads each. Returns True if output_file was
+    written and passed verification.
+    """
+    workers = max(1, (threads or os.cpu_count() or 1) // CHUNK_THREADS)
+    work_dir = scratch.mkdtemp(prefix="disconvert_chunks_")
+    try:
+        sources = split(input_file, work_dir)
+        if not sources:
+            log("Chunked: splitting failed")
+            return False
+        log(f"Chunked: encoding {len(sources)} segments, {workers} at a time")
+        outputs = [path[:-len(".mkv")].replace("source_", "encoded_") + ".mp4" for path in sources]
+        control = current_control()
+
+        def encode(pair):
+            # Cancelling or pausing the file reaches its segments too
+            with controlled(control):
+                return output_ok(encode_segment(*pair, CHUNK_THREADS), pair[1])
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # carry keeps the segments' ffmpeg usage in the calling thread's stage
+            encoded = list(executor.map(metrics.carry(encode), zip(sources, outputs)))
+        if not all(encoded):
+            log("Chunked: a segment failed to encode")
+            return False
+
+        audio_file = encode_audio(input_file, work_dir, audio_args)
+        if not concat(outputs, audio_file, output_file, work_dir):
+            log("Chunked: joining the segments failed")
+            return False
+        if not verify(output_file, duration, log):
+            os.remove(output_file)
+            return False
+        return True
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
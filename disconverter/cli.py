@@ -0,0 +1,148 @@
+"""Command line front end of the engine.
+
+    python disconvert-light.py SOURCE OUTPUT [--max-size MB [MB ...]] [--jobs N] [--deadline MINUTES] [--watch]
+
+Without SOURCE and OUTPUT the folders are read from paths.txt (line 2 and 3),
+the same file the GUI saves them to.
+"""
+import argparse
+import os
+import shutil
+import signal
+import threading
+import time
+
+from . import jobs, pool
+from .engine import MAX_SIZE_MB, VIDEO_EXTENSIONS, Engine
+
+PATHS_FILE = "paths.txt"
+PREFIX = "shrunk_video_"
+
+print_lock = threading.Lock()  # events come from several workers, keep their lines whole
+
+
+def read_paths(path=PATHS_FILE):
+    """Returns the source and output folders saved in paths.txt, whose first line is a comment."""
+    with open(path, "r") as file:
+        lines = file.readlines()
+    source = lines[1].strip() if len(lines) > 1 else None
+    output = lines[2].strip() if len(lines) > 2 else None
+    return source, output
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Convert videos to H.264 and compress copies for Discord.")
+    parser.add_argument("source", nargs="?", help="folder with the videos (default: line 2 of paths.txt)")
+    parser.add_argument("output", nargs="?", help="folder for the compressed copies (default: line 3 of paths.txt)")
+    parser.add_argument("-s", "--max-size", type=int, nargs="+", default=[MAX_SIZE_MB], metavar="MB",
+                        help=f"size cap of the compressed copies (default: {MAX_SIZE_MB}); several caps, "
+                             f"e.g. 10 25 50 500, make one copy per cap in OUTPUT/<cap>MB")
+    parser.add_argument("-j", "--jobs", type=int, default=pool.default_jobs(),
+                        help="videos processed at once, the cores are split between them")
+    parser.add_argument("--order", choices=jobs.ORDERS, default="shortest",
+                        help="processing order: shortest first, biggest savings first or as listed")
+    parser.add_argument("--scratch", metavar="DIR",
+                        help="where intermediates are written, e.g. a fast local disk with room for the biggest video "
+                             "(default: the system temp folder)")
+    budget = parser.add_mutually_exclusive_group()
+    budget.add_argument("--deadline", type=float, metavar="MINUTES",
+                        help="finish the batch within MINUTES, using faster x264 presets as needed")
+    budget.add_argument("--speed", type=float, metavar="FACTOR",
+                        help="keep the batch at FACTOR seconds of video per second, using faster x264 presets "
+                             "as needed (default: always the slow preset)")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and process videos as they appear in the source folder")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write Prometheus text-format stage metrics to FILE after every video")
+    args = parser.parse_args(argv)
+    if args.source is None or args.output is None:
+        try:
+            saved = read_paths()
+        except OSError:
+            parser.error(f"give SOURCE and OUTPUT, or set them in {PATHS_FILE}")
+        args.source = args.source or saved[0]
+        args.output = args.output or saved[1]
+        if not args.source or not args.output:
+            parser.error(f"{PATHS_FILE} needs the source folder on line 2 and the output folder on line 3")
+    return args
+
+
+def print_event(event):
+    if event.kind == "log":
+        with print_lock:
+            print(event.message)
+
+
+def run_batch(engine, source):
+    """Processes every video in source. Returns the Results."""
+    video_paths = engine.scan(source)
+    print(f"Checking {len(video_paths)} videos in {source} ({engine.jobs} parallel jobs)\n")
+    results = engine.run(video_paths)
+    reencoded = [os.path.basename(result.path) for result in results if result.reencoded]
+    if reencoded:
+        print("Re-encoded files:")
+        for name in reencoded:
+            print(name)
+        print()
+    return results
+
+
+def watch(engine, source):
+    """Service mode: processes videos as they are dropped into source, until Ctrl+C.
+
+    The videos already there are worked through in the background; new
+    ones go first, pausing the background encodes until they are done.
+    """
+    from .watch import FolderWatcher  # ctypes and inotify, only the service mode needs them
+
+    engine.backfill(engine.scan(source))
+    # The backfill has the existing videos, the watcher only reports what changes after it
+    watcher = FolderWatcher(source, VIDEO_EXTENSIONS, initial_scan=False)
+    print(f"Watching {source} for new videos ({type(watcher.backend).__name__}), Ctrl+C to stop\n")
+    try:
+        for file_path in watcher.changes():
+            engine.submit(file_path, priority=True)
+    finally:
+        watcher.close()
+
+
+def main(argv=None):
+    """Runs the command line. Returns the exit status: 1 if a video failed, 130 if it was stopped."""
+    args = parse_args(argv)
+    if shutil.which("ffmpeg") is None:
+        print("Error: ffmpeg is not installed. Please install it first.")
+        return 1
+    print(f"Source: {args.source}\nOutput: {args.output}\n")
+    failed = []
+
+    def on_event(event):
+        if event.kind == "failed":
+            failed.append(event.path)
+        print_event(event)
+
+    deadline = time.time() + args.deadline * 60 if args.deadline else None
+    engine = Engine(args.output, jobs=args.jobs, tiers=args.max_size, on_event=on_event, prefix=PREFIX,
+                    order=args.order, scratch_dir=args.scratch, deadline=deadline, speed=args.speed,
+                    metrics_file=args.metrics)
+
+    def stop(signum, frame):
+        # Kill the running encodes right away instead of waiting them out
+        engine.cancel()
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        if args.watch:
+            watch(engine, args.source)
+        else:
+            results = run_batch(engine, args.source)
+            failed += [result.path for result in results if result.failed]
+    except KeyboardInterrupt:
+        print("\nStopped, unfinished videos resume on the next run")
+        return 130
+    finally:
+        engine.close()
+        for line in engine.summary():
+            print(line)
+    return 1 if failed else 0
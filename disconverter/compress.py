@@ -0,0 +1,476 @@
+"""Size-capped compression for the Discord copies."""
+import os
+import shutil
+from contextlib import ExitStack, contextmanager
+
+from . import chunked as chunks, metrics, planner, scratch
+from .budget import DEFAULT_PRESET, search_preset
+from .ffmpeg import output_ok, progress_bytes, progress_seconds, run_ffmpeg, thread_args
+from .probe import is_complete, probe_video
+from .target import AUDIO_BITRATE_KBPS, CONTAINER_OVERHEAD, MIN_VIDEO_BITRATE_KBPS, Target, plan_target
+
+MAX_TWO_PASS_TRIES = 2
+MASTER_CRF = 18
+MAX_PLANNED_TRIES = 3
+ABORT_MIN_PROGRESS = 0.1  # share of the duration encoded before projecting
+ABORT_MARGIN = 0.25  # allowed projected overshoot at the start, shrinks to 0 at the end
+
+
+def size_mb(file_path):
+    return os.path.getsize(file_path) / (1024 * 1024)
+
+
+class SizeGuard:
+    """Progress callback that stops an encode once it clearly won't fit max_size_mb.
+
+    An attempt is stopped as soon as it has written more than the cap, or, once
+    enough of the duration is encoded, when its size projected to the full
+    duration exceeds the cap by more than a margin that shrinks as it goes.
+    """
+
+    def __init__(self, max_size_mb, duration=None):
+        self.max_bytes = max_size_mb * 1024 * 1024
+        self.duration = duration
+        self.aborted = False
+        self.projected_mb = None
+
+    def __call__(self, block):
+        written = progress_bytes(block)
+        elapsed = progress_seconds(block)
+        if not written:
+            return True
+        if written > self.max_bytes:
+            return self.abort(written)
+        if not self.duration or not elapsed:
+            return True
+        done = min(elapsed / self.duration, 1.0)
+        if done < ABORT_MIN_PROGRESS:
+            return True
+        projected = written / done
+        if projected > self.max_bytes * (1 + ABORT_MARGIN * (1 - done)):
+            return self.abort(projected)
+        return True
+
+    def abort(self, projected):
+        self.aborted = True
+        self.projected_mb = projected / (1024 * 1024)
+        return False
+
+
+def attempt_outcome(event, actual_mb, guard, max_size_mb):
+    """Records how a compress attempt ended in its metrics event."""
+    if actual_mb is None:
+        event["outcome"] = "missing"
+    elif guard.aborted:
+        event["outcome"] = "aborted"
+        event["projected_mb"] = round(actual_mb, 2)
+    else:
+        event["outcome"] = "fit" if actual_mb <= max_size_mb else "overshot"
+        event["bytes_out"] = int(actual_mb * 1024 * 1024)
+
+
+def attempt_size(output_file, guard, returncode=0):
+    """Returns an attempt's size in MB, or None if ffmpeg failed or wrote nothing.
+
+    A stopped attempt is removed and its projected size returned instead.
+    """
+    if guard.aborted:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        return guard.projected_mb
+    if not output_ok(returncode, output_file):
+        return None
+    return size_mb(output_file)
+
+
+@contextmanager
+def passlog_prefix():
+    """Yields a temporary x264 stats file name and removes the stats afterwards."""
+    log_dir = scratch.mkdtemp(prefix="disconvert_")
+    try:
+        yield os.path.join(log_dir, "x264.log")
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+def audio_args(copy=False):
+    """Returns the audio output options; copy keeps audio that is already AAC at or under 128k."""
+    if copy:
+        return ["-c:a", "copy"]
+    return ["-c:a", "aac", "-b:a", f"{AUDIO_BITRATE_KBPS}k"]
+
+
+def master_video_args(threads=None, preset=DEFAULT_PRESET):
+    return ["-c:v", "libx264", "-preset", preset, "-crf", str(MASTER_CRF), *thread_args(threads)]
+
+
+def master_args(threads=None, copy_audio=False, preset=DEFAULT_PRESET):
+    """Returns the output options of the near-lossless H.264 master."""
+    return [*master_video_args(threads, preset), *audio_args(copy_audio)]
+
+
+def two_pass_args(video_kbps, passlog, threads=None, target=None, preset=DEFAULT_PRESET):
+    # x264 runs the first pass with faster settings of its own, whatever the preset.
+    # -passlogfile would name the stats after the output stream's index, which
+    # differs between the passes once a run has several outputs, so x264 gets
+    # the file itself. The quotes keep a Windows drive colon out of the
+    # x264-params separators. The null muxer of pass 1 and the mp4 one of
+    # pass 2 would time frames differently; with cfr both passes see the same
+    # frames, or pass 2 rejects the stats as incomplete.
+    return ["-c:v", "libx264", "-preset", preset, "-b:v", f"{video_kbps}k", "-x264-params", f"stats='{passlog}'",
+            "-fps_mode", "cfr", *thread_args(threads), *(target or Target()).video_args()]
+
+
+def encode_master(input_file, output_file, threads=None, duration=None, chunked=False, log=print,
+                  copy_audio=False, preset=DEFAULT_PRESET):
+    """Re-encodes a video to the H.264 master. Returns True if ffmpeg succeeded and wrote the output.
+
+    With chunked, long videos are encoded as parallel segments, falling back
+    to a single encode if that fails.
+    """
+    bytes_in = metrics.file_size(input_file)
+    if chunked and chunks.applies(duration):
+        with metrics.stage("reencode", method="chunked", preset=preset, bytes_in=bytes_in) as event:
+            done = chunks.encode_chunked(
+                input_file, output_file,
+                lambda source, output, t: run_ffmpeg(["-i", source, *master_video_args(t, preset), output]),
+                audio_args(copy_audio), duration, threads, log
+            )
+            metrics.set_output(event, output_file)
+        if done:
+            return True
+        log("Chunked encode failed, encoding the master in one piece")
+    with metrics.stage("reencode", method="master", crf=MASTER_CRF, preset=preset, bytes_in=bytes_in) as event:
+        returncode = run_ffmpeg(["-i", input_file, *master_args(threads, copy_audio, preset), output_file])
+        written = output_ok(returncode, output_file)
+        metrics.set_output(event, output_file)
+    return written
+
+
+def encode_two_pass(input_file, output_file, video_kbps, threads=None, guard=None, target=None,
+                    preset=DEFAULT_PRESET):
+    """Runs a two-pass libx264 encode at the given bitrate, watching the second pass with guard.
+
+    The target supplies the scaling and audio options; None keeps the source
+    resolution and re-encodes the audio at 128k. Returns ffmpeg's exit code,
+    that of the first pass if it failed.
+    """
+    target = target or Target()
+    with passlog_prefix() as passlog:
+        video = two_pass_args(video_kbps, passlog, threads, target, preset)
+        returncode = run_ffmpeg(["-i", input_file, *video, "-pass", "1", "-an", "-f", "null", os.devnull])
+        if returncode != 0:
+            return returncode
+        return run_ffmpeg(["-i", input_file, *video, "-pass", "2", *target.audio_args(), output_file],
+                          on_progress=guard)
+
+
+def encode_fused(input_file, master_file, output_file, video_kbps, threads=None, copy_audio=False, target=None,
+                 preset=DEFAULT_PRESET):
+    """Writes the H.264 master and the two-pass Discord copy from a single decode.
+
+    The analysis pass reads the source on its own; the second pass is an extra
+    output of the master encode, so ffmpeg decodes each frame once and feeds
+    both encoders. Only the Discord copy is scaled to the target; the master
+    keeps the source resolution. Returns (master_written, output_written);
+    if ffmpeg fails neither counts as written and both are removed.
+    """
+    target = target or Target(copy_audio=copy_audio)
+    with passlog_prefix() as passlog:
+        video = two_pass_args(video_kbps, passlog, threads, target, preset)
+        returncode = run_ffmpeg(["-i", input_file, *video, "-pass", "1", "-an", "-f", "null", os.devnull])
+        if returncode == 0:
+            returncode = run_ffmpeg([
+                "-i", input_file,
+                *master_args(threads, copy_audio, preset), master_file,
+                *video, "-pass", "2", *target.audio_args(), output_file
+            ])
+    return output_ok(returncode, master_file), output_ok(returncode, output_file)
+
+
+def crf_attempt(input_file, output_file, crf, max_size_mb, threads=None, target=None, preset=DEFAULT_PRESET,
+                method="crf-walk"):
+    """Runs one guarded CRF encode as a compress stage. Returns its size in MB and whether it was stopped early."""
+    guard = SizeGuard(max_size_mb)
+    with metrics.stage("compress", method=method, crf=crf, preset=preset,
+                       bytes_in=metrics.file_size(input_file)) as event:
+        returncode = encode_crf(input_file, output_file, crf, threads, guard, target, preset)
+        attempt_mb = attempt_size(output_file, guard, returncode)
+        attempt_outcome(event, attempt_mb, guard, max_size_mb)
+    return attempt_mb, guard.aborted
+
+
+def compress_crf_walk(input_file, output_file, max_size_mb=10, log=print, threads=None, target=None,
+                      preset=DEFAULT_PRESET):
+    """Compresses video until it's under the specified size by raising CRF.
+
+    The walk runs at a fast preset; once a CRF fits, the output is encoded
+    again at that CRF with preset, and the walk goes on if that overshoots.
+    """
+    crf = 28  # Start with moderate compression
+    max_crf = 51  # Maximum CRF (lower quality)
+    search = search_preset(preset)
+
+    while crf <= max_crf:
+        attempt_mb, aborted = crf_attempt(input_file, output_file, crf, max_size_mb, threads, target, search)
+        if attempt_mb is None:
+            log("Error: Output file not created")
+            return False
+        if not aborted and attempt_mb <= max_size_mb:
+            if search == preset:
+                return True
+            os.remove(output_file)
+            attempt_mb, aborted = crf_attempt(input_file, output_file, crf, max_size_mb, threads, target, preset,
+                                              method="crf-final")
+            if attempt_mb is None:
+                log("Error: Output file not created")
+                return False
+            if not aborted and attempt_mb <= max_size_mb:
+                return True
+            log(f"CRF {crf} fit at {search} but not at {preset} ({attempt_mb:.2f} MB)")
+        # Increase compression if file is still too large
+        crf += 2
+        if os.path.exists(output_file):
+            os.remove(output_file)
+
+    return False
+
+
+def encode_crf(input_file, output_file, crf, threads=None, guard=None, target=None, preset=DEFAULT_PRESET):
+    """Runs a single CRF libx264 encode, stopped early if guard says it won't fit. Returns ffmpeg's exit code."""
+    target = target or Target()
+    return run_ffmpeg([
+        "-i", input_file,
+        "-c:v", "libx264",
+        "-preset", preset,
+        "-crf", str(crf),
+        *thread_args(threads),
+        *target.video_args(),
+        *target.audio_args(),
+        output_file
+    ], on_progress=guard)
+
+
+def compress_crf(input_file, output_file, max_size_mb=10, log=print, threads=None, duration=None,
+                 target=None, preset=DEFAULT_PRESET):
+    """Compresses video under max_size_mb at a CRF planned from sample encodes.
+
+    Falls back to raising CRF step by step when the duration is unknown.
+    """
+    target = target or Target()
+    model = None
+    if duration:
+        model = planner.build_model(input_file, duration, target.audio_kbps, CONTAINER_OVERHEAD, threads,
+                                    target.video_args(), preset)
+    if model is None:
+        return compress_crf_walk(input_file, output_file, max_size_mb, log=log, threads=threads, target=target,
+                                 preset=preset)
+
+    last_crf = None
+    for _ in range(MAX_PLANNED_TRIES):
+        crf = model.pick_crf(max_size_mb)
+        if crf is None:
+            log(f"Planner: even CRF {planner.MAX_CRF} is predicted to exceed {max_size_mb} MB")
+            return False
+        if last_crf is not None and crf <= last_crf:
+            crf = last_crf + 1
+        if crf > planner.MAX_CRF:
+            return False
+        predicted_mb = model.predict_mb(crf)
+
+        guard = SizeGuard(max_size_mb, duration)
+        with metrics.stage("compress", method="crf", crf=crf, preset=preset, predicted_mb=round(predicted_mb, 2),
+                           bytes_in=metrics.file_size(input_file)) as event:
+            returncode = encode_crf(input_file, output_file, crf, threads, guard, target, preset)
+            actual_mb = attempt_size(output_file, guard, returncode)
+            attempt_outcome(event, actual_mb, guard, max_size_mb)
+        if actual_mb is None:
+            log("Error: Output file not created")
+            return False
+        if guard.aborted:
+            log(f"Planner: CRF {crf}, predicted {predicted_mb:.2f} MB, stopped early at a projected {actual_mb:.2f} MB")
+        else:
+            log(f"Planner: CRF {crf}, predicted {predicted_mb:.2f} MB, actual {actual_mb:.2f} MB")
+            if actual_mb <= max_size_mb:
+                return True
+            os.remove(output_file)
+        model.correct(actual_mb, predicted_mb)
+        last_crf = crf
+
+    return False
+
+
+def compress_video(input_file, output_file, max_size_mb=10, two_pass=True, log=print, threads=None,
+                   info=None, chunked=False, copy_audio=False, preset=DEFAULT_PRESET):
+    """Compresses video under max_size_mb, copying the audio if copy_audio is set.
+
+    The resolution, frame rate and bitrates are planned from the probe up front,
+    so sources the budget spreads too thin are scaled down instead of starved.
+    With two_pass the video bitrate is worked out from the duration so a single
+    two-pass encode lands under the cap; a planned CRF encode is only used when
+    the budget is too small or two-pass still overshoots.
+    Pass the VideoInfo from an earlier probe to avoid probing the file again.
+    With chunked, the two-pass encodes of long videos run as parallel segments.
+    preset is the x264 preset of the outputs that are kept.
+    """
+    if info is None:
+        info = probe_video(input_file)
+    duration = info.duration if info else None
+    target = plan_target(info, max_size_mb, copy_audio)
+    if target.adjusted:
+        log(f"Target: {target.describe()}")
+    video_kbps = target.video_kbps if two_pass else None
+
+    tries = 0
+    while video_kbps and tries < MAX_TWO_PASS_TRIES:
+        tries += 1
+        guard = SizeGuard(max_size_mb, duration)
+        split = chunked and chunks.applies(duration)
+        with metrics.stage("compress", method="chunked two-pass" if split else "two-pass", kbps=video_kbps,
+                           preset=preset, bytes_in=metrics.file_size(input_file)) as event:
+            if split:
+                done = chunks.encode_chunked(
+                    input_file, output_file,
+                    lambda source, output, t: encode_two_pass(source, output, video_kbps, t, target=target,
+                                                              preset=preset),
+                    target.audio_args(), duration, threads, log
+                )
+                returncode = 0 if done else 1
+            else:
+                returncode = encode_two_pass(input_file, output_file, video_kbps, threads, guard, target, preset)
+            actual_mb = attempt_size(output_file, guard, returncode)
+            attempt_outcome(event, actual_mb, guard, max_size_mb)
+        if actual_mb is None:
+            log("Error: Two-pass output not created, falling back to CRF")
+            break
+        if not guard.aborted:
+            if actual_mb <= max_size_mb:
+                return True
+            os.remove(output_file)
+        # Scale the bitrate by the overshoot and leave some headroom
+        video_kbps = int(video_kbps * max_size_mb / actual_mb * 0.95)
+        log(f"Two-pass overshot ({actual_mb:.2f} MB), retrying at {video_kbps}k")
+        if video_kbps < MIN_VIDEO_BITRATE_KBPS:
+            break
+
+    return compress_crf(input_file, output_file, max_size_mb, log=log, threads=threads, duration=duration,
+                        target=target, preset=preset)
+
+
+def compress_fused(input_file, master_file, output_file, max_size_mb=10, info=None, log=print, threads=None,
+                   chunked=False, copy_audio=False, preset=DEFAULT_PRESET):
+    """Encodes the H.264 master and the Discord copy together, both straight from the source.
+
+    Returns None if the size budget can't be met with two-pass, in which case
+    nothing was encoded and the caller should use encode_master and
+    compress_video, as it also does for videos that chunked mode will split.
+    Otherwise returns whether the Discord copy fits; an
+    oversize or incomplete copy is removed. The master is written unless
+    ffmpeg failed.
+    """
+    duration = info.duration if info else None
+    target = plan_target(info, max_size_mb, copy_audio)
+    if target.video_kbps is None or (chunked and chunks.applies(duration)):
+        return None
+
+    if target.adjusted:
+        log(f"Target: {target.describe()}")
+    with metrics.stage("reencode", method="fused", kbps=target.video_kbps, preset=preset,
+                       bytes_in=metrics.file_size(input_file)) as event:
+        _, written = encode_fused(input_file, master_file, output_file, target.video_kbps, threads, copy_audio,
+                                  target, preset)
+        metrics.set_output(event, master_file)
+        event["copy_bytes"] = metrics.file_size(output_file)
+        if written and not is_complete(output_file, duration):
+            os.remove(output_file)
+            written = False
+        actual_mb = size_mb(output_file) if written else None
+        event["outcome"] = "missing" if actual_mb is None else "fit" if actual_mb <= max_size_mb else "overshot"
+    if not written:
+        log("Error: Fused output not created")
+        return False
+    if actual_mb > max_size_mb:
+        log(f"Fused two-pass overshot ({actual_mb:.2f} MB)")
+        os.remove(output_file)
+        return False
+    return True
+
+
+def encode_ladder(input_file, targets, threads=None, preset=DEFAULT_PRESET):
+    """Writes two-pass copies for several targets with one analysis run and one encode run.
+
+    targets maps each output file to its Target. Each run decodes the source
+    once and feeds every encoder. x264's first-pass stats only describe frames
+    of the size it analysed, so there is one analysis per frame size, which
+    the copies of that size share at their own bitrates. Returns ffmpeg's
+    exit code, the analysis run's if that failed.
+    """
+    groups = {}
+    for output_file, target in targets.items():
+        groups.setdefault(tuple(target.video_args()), []).append(output_file)
+    with ExitStack() as stack:
+        passlogs = {key: stack.enter_context(passlog_prefix()) for key in groups}
+        first, second = [], []
+        for key, outputs in groups.items():
+            target = targets[outputs[0]]
+            first += [*two_pass_args(target.video_kbps, passlogs[key], threads, target, preset),
+                      "-pass", "1", "-an", "-f", "null", os.devnull]
+            for output_file in outputs:
+                target = targets[output_file]
+                second += [*two_pass_args(target.video_kbps, passlogs[key], threads, target, preset),
+                           "-pass", "2", *target.audio_args(), output_file]
+        returncode = run_ffmpeg(["-i", input_file, *first])
+        if returncode != 0:
+            return returncode
+        return run_ffmpeg(["-i", input_file, *second])
+
+
+def compress_ladder(input_file, outputs, info=None, log=print, threads=None, chunked=False, copy_audio=False,
+                    preset=DEFAULT_PRESET):
+    """Compresses one video under several size caps, outputs mapping each cap in MB to its file.
+
+    Every cap two-pass can plan for is encoded by encode_ladder, so the source
+    is analysed and decoded once for all of them. A copy that overshoots or
+    comes out empty or incomplete, or a cap too small for two-pass, goes
+    through compress_video on its own.
+    Returns {cap: fits}.
+    """
+    if info is None:
+        info = probe_video(input_file)
+    targets = {max_size_mb: plan_target(info, max_size_mb, copy_audio) for max_size_mb in outputs}
+    caps = [max_size_mb for max_size_mb, target in targets.items() if target.video_kbps]
+
+    results = {}
+    if len(caps) > 1:
+        log(f"Ladder: {', '.join(f'{cap:g} MB' for cap in caps)} from one analysis pass")
+        for cap in caps:
+            if targets[cap].adjusted:
+                log(f"Target for {cap:g} MB: {targets[cap].describe()}")
+        with metrics.stage("compress", method="ladder", tiers=len(caps), preset=preset,
+                           bytes_in=metrics.file_size(input_file)) as event:
+            returncode = encode_ladder(input_file, {outputs[cap]: targets[cap] for cap in caps}, threads, preset)
+            event["bytes_out"] = sum(metrics.file_size(outputs[cap]) or 0 for cap in caps)
+            missing = False
+            for cap in caps:
+                written = output_ok(returncode, outputs[cap])
+                if written and not is_complete(outputs[cap], info.duration if info else None):
+                    os.remove(outputs[cap])
+                    written = False
+                if not written:
+                    log(f"Ladder: the {cap:g} MB copy wasn't created")
+                    missing = True
+                    results[cap] = False
+                    continue
+                results[cap] = size_mb(outputs[cap]) <= cap
+                if not results[cap]:
+                    log(f"Ladder: the {cap:g} MB copy overshot ({size_mb(outputs[cap]):.2f} MB)")
+                    os.remove(outputs[cap])
+            event["outcome"] = ("fit" if all(results[cap] for cap in caps)
+                                else "missing" if missing else "overshot")
+
+    for max_size_mb, output_file in outputs.items():
+        if not results.get(max_size_mb):
+            results[max_size_mb] = compress_video(input_file, output_file, max_size_mb, log=log, threads=threads,
+                                                  info=info, chunked=chunked, copy_audio=copy_audio,
+                                                  preset=preset)
+    return results
@@ -0,0 +1,578 @@
+"""Headless conversion engine shared by the GUI, the command line and anything else.
+
+    engine = Engine("out", max_size_mb=10, jobs=2, on_event=print)
+    results = engine.run(engine.scan("videos"))      # a whole batch, blocking
+    future = engine.submit("videos/new.mkv")         # or one file at a time
+    engine.close()
+
+An Engine owns the fingerprint index, the job queue, the output cache and the
+stage metrics. Everything it does is reported as Events to on_event, from the
+worker threads: "status" and "log" messages, "started", "progress", "done",
+"failed" and "cancelled". Running files can be cancelled, paused and resumed;
+a file submitted with priority=True pauses the others until it is done.
+Given a deadline or a speed, the x264 preset of each file is picked to keep
+the batch on time. Nothing here imports tkinter.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from . import compress, jobs, metrics, pool
+from .budget import DEFAULT_PRESET, PRESETS, Budget
+from .cache import OutputCache
+from .ffmpeg import (PAUSE_SUPPORTED, Cancelled, Control, controlled, progress_fps, progress_listener,
+                     progress_seconds, progress_speed, run_listener)
+from .index import DB_PATH, LEGACY_PATH, FileIndex
+from .jobs import JobQueue
+from .probe import is_complete, probe_video
+from .scratch import Scratch, move_into_place
+from .streams import plan_streams, remux_to_mp4, remuxed_path
+
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov", ".wmv", ".flv")
+MAX_SIZE_MB = 10
+PREFIX = "shrunk_"
+
+
+@dataclass
+class Event:
+    kind: str  # "status", "log", "started", "progress", "done" or "failed"
+    path: str = None
+    message: str = None
+    data: dict = field(default_factory=dict)
+
+
+@dataclass
+class Result:
+    path: str  # where the file ended up, a remux can give it a new name
+    skipped: bool = False  # already processed, nothing was done
+    reencoded: bool = False  # the master was written, or remuxed
+    discord_file: str = None  # the Discord copy under the smallest cap, if one was made or reused
+    copies: dict = field(default_factory=dict)  # every Discord copy, by size cap in MB
+    failed: bool = False  # a Discord copy was needed but didn't fit
+
+
+class Engine:
+    """Converts videos to H.264 masters and makes Discord copies of the ones over the size cap.
+
+    fused encodes the master and the Discord copy of large files from one
+    decode, chunked splits long videos into parallel segments. order is one
+    of jobs.ORDERS. redo also revisits processed files to recreate missing
+    Discord copies. tiers, a list of size caps in MB, replaces max_size_mb
+    with a ladder: one copy per cap in its own "<cap>MB" folder, made from
+    one analysis pass where the caps allow the same frame size, and none for
+    caps the video already fits. Intermediates go to scratch_dir, the system temp
+    directory by default. deadline, a time.time() the queue should be done
+    by, or speed, a realtime factor it should keep, trade the x264 preset
+    for throughput; see budget.Budget. Without either everything is encoded
+    at slow. cache=False turns the output cache off,
+    events_path=None the event log; metrics_file is rewritten after every file.
+    """
+
+    def __init__(self, output_dir, max_size_mb=MAX_SIZE_MB, jobs=1, on_event=None, prefix=PREFIX,
+                 fused=True, chunked=True, order="shortest", redo=False, cache=True, scratch_dir=None, tiers=None,
+                 deadline=None, speed=None, db_path=DB_PATH, legacy_path=LEGACY_PATH,
+                 events_path=metrics.EVENTS_PATH, metrics_file=None):
+        self.output_dir = output_dir
+        self.tiers = tuple(sorted(tiers)) if tiers else (max_size_mb,)
+        self.max_size_mb = self.tiers[0]
+        self.jobs = max(1, jobs)
+        self.on_event = on_event
+        self.prefix = prefix
+        self.fused = fused
+        self.chunked = chunked
+        self.order = order
+        self.redo = redo
+        self.events_path = events_path
+        self.metrics_file = metrics_file
+        self.index = FileIndex(db_path, legacy_path)
+        self.job_queue = JobQueue(db_path)
+        self.output_cache = OutputCache(db_path) if cache else None
+        self.recorder = metrics.Metrics(events_path)
+        self.scratch = Scratch(scratch_dir)
+        self.budget = Budget(deadline, speed, self.jobs) if deadline or speed else None
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.controls = {}  # Control -> (file path, priority) of the running jobs
+        self.submitted = set()  # paths queued or running on either lane
+        self.workers = None
+        self.priority_lane = None
+        self.preempting = 0  # priority files running, the others are paused meanwhile
+        self.paused = False
+        self.cancelled = False
+
+    @property
+    def max_bytes(self):
+        return self.max_size_mb * 1024 * 1024
+
+    def copy_path(self, name, max_size_mb):
+        """Returns where the Discord copy of a video named name goes for a size cap."""
+        if len(self.tiers) > 1:
+            return os.path.join(self.output_dir, f"{max_size_mb:g}MB", self.prefix + name)
+        return os.path.join(self.output_dir, self.prefix + name)
+
+    def cache_keys(self, file_path, fingerprint):
+        """Returns the fingerprints a file's copies are cached under.
+
+        fingerprint is the source's, from before it was converted, so
+        duplicates of the original find the copy; the current content's
+        covers a Redo of the converted file.
+        """
+        return list(dict.fromkeys((fingerprint, self.index.fingerprint(file_path)[0])))
+
+    def cache_copy(self, file_path, fingerprint, max_size_mb, discord_file, preset=DEFAULT_PRESET):
+        if self.output_cache is not None:
+            for key in self.cache_keys(file_path, fingerprint):
+                self.output_cache.store(key, max_size_mb, discord_file, preset)
+
+    def cached_copy(self, file_path, fingerprint, max_size_mb, discord_file, preset=DEFAULT_PRESET):
+        """Puts a cached copy of a file at discord_file. Returns False on a miss.
+
+        Only copies encoded at preset or a slower one, the best first, are
+        good enough; one rushed out under a tight budget isn't.
+        """
+        if self.output_cache is None:
+            return False
+        good_enough = reversed(PRESETS[PRESETS.index(preset):])
+        return any(self.output_cache.fetch(key, max_size_mb, discord_file, candidate)
+                   for candidate in good_enough for key in self.cache_keys(file_path, fingerprint))
+
+    def duplicate_copies(self, file_path, fingerprint):
+        """Gives a processed file the Discord copies it is missing, from the cache only. Returns {cap: path}.
+
+        A duplicate of a file that was already converted is skipped, but its
+        copies are made from the same content, so the cache has them.
+        """
+        name = os.path.basename(file_path)
+        size = os.path.getsize(file_path)
+        preset = self.budget.pick() if self.budget is not None else DEFAULT_PRESET
+        copies = {}
+        for max_size_mb in self.tiers:
+            discord_file = self.copy_path(name, max_size_mb)
+            if size <= max_size_mb * 1024 * 1024 or os.path.exists(discord_file):
+                continue
+            os.makedirs(os.path.dirname(discord_file), exist_ok=True)
+            if self.cached_copy(file_path, fingerprint, max_size_mb, discord_file, preset):
+                self.log(f"Reused cached Discord copy: {os.path.relpath(discord_file, self.output_dir)}")
+                copies[max_size_mb] = discord_file
+        return copies
+
+    def emit(self, kind, path=None, message=None, **data):
+        if self.on_event is not None:
+            self.on_event(Event(kind, path, message, data))
+
+    def status(self, message):
+        self.emit("status", message=message)
+
+    def log(self, message):
+        self.emit("log", message=message)
+
+    def clean(self, directory):
+        """Removes the temp files an interrupted run left in directory and in the scratch space."""
+        for name in jobs.remove_orphans(directory) + self.scratch.remove_stale():
+            self.log(f"Removed leftover temp file: {name}")
+
+    def scan(self, directory):
+        """Returns the videos in a directory, after cleaning it up."""
+        self.clean(directory)
+        return [os.path.join(directory, name) for name in os.listdir(directory)
+                if name.lower().endswith(VIDEO_EXTENSIONS)]
+
+    def prefetch(self, file_path):
+        """Fingerprints and probes a file ahead of its encode so both are cached by then. Returns the VideoInfo.
+
+        Files that still need work count towards the budget, if there is one.
+        """
+        with metrics.recording(self.recorder, file_path):
+            processed, _ = self.index.check(file_path)
+            info = probe_video(file_path, self.index)
+        if self.budget is not None and info and (not processed or self.redo):
+            self.budget.add(file_path, info.duration)
+        return info
+
+    def measure_queue(self, file_paths):
+        """Prefetches every queued file when there is a budget, which needs the length of the whole queue."""
+        if self.budget is not None:
+            for file_path in file_paths:
+                pool.prepare_quietly(self.prefetch, file_path)
+
+    def run(self, file_paths, should_continue=None, on_done=None):
+        """Processes a batch on `jobs` workers, interrupted jobs first. Returns the Results.
+
+        Files that haven't started yet are skipped once should_continue()
+        returns False; on_done is passed on to pool.run_pool.
+        """
+        self.index.retire_legacy(file_paths)
+        self.job_queue.add(file_paths)
+        file_paths = self.job_queue.ordered(file_paths, self.order, self.prefetch)
+        self.measure_queue(file_paths)
+        results = []
+
+        def process(file_path, threads):
+            result = self.process_job(file_path, threads)
+            with self.lock:
+                results.append(result)
+
+        def running():
+            return not self.cancelled and (should_continue is None or should_continue())
+
+        pool.run_pool(file_paths, process, jobs=self.jobs, should_continue=running, on_done=on_done,
+                      on_error=self.report_error, prepare=self.prefetch)
+        return results
+
+    def submit(self, file_path, priority=False):
+        """Queues one file on the background workers.
+
+        With priority the file skips the queue and runs on its own lane at
+        once, with all the cores, while the other running files are paused.
+        Returns a Future of its Result, or None if the file is already queued
+        or running, on either lane.
+        """
+        with self.lock:
+            if file_path in self.submitted:
+                return None
+            self.submitted.add(file_path)
+        future = self.submit_to_lane(file_path, priority)
+        if future is None:
+            self.unsubmit(file_path)
+        else:
+            future.add_done_callback(lambda _: self.unsubmit(file_path))
+        return future
+
+    def unsubmit(self, file_path):
+        with self.lock:
+            self.submitted.discard(file_path)
+
+    def submit_to_lane(self, file_path, priority):
+        if priority:
+            if self.priority_lane is None:
+                self.priority_lane = pool.WorkerPool(self.process_priority, 1, on_error=self.report_error,
+                                                     prepare=self.prefetch)
+            self.job_queue.add([file_path])
+            return self.priority_lane.submit(file_path)
+        if self.workers is None:
+            self.workers = pool.WorkerPool(self.process_job, self.jobs, on_error=self.report_error,
+                                           prepare=self.prefetch)
+        self.job_queue.add([file_path])
+        return self.workers.submit(file_path)
+
+    def backfill(self, file_paths):
+        """Submits a batch to the background workers in the configured order, interrupted jobs first.
+
+        Returns their Futures. Unlike run() it doesn't block, and priority
+        files submitted meanwhile go first.
+        """
+        self.index.retire_legacy(file_paths)
+        self.job_queue.add(file_paths)
+        file_paths = self.job_queue.ordered(file_paths, self.order, self.prefetch)
+        self.measure_queue(file_paths)
+        return [future for future in map(self.submit, file_paths) if future is not None]
+
+    def report_error(self, file_path, e):
+        if isinstance(e, Cancelled):
+            self.log(f"Cancelled: {os.path.basename(file_path)}, it resumes on the next run")
+        else:
+            self.log(f"Error processing {os.path.basename(file_path)}: {e}\n")
+
+    def process_priority(self, file_path, threads=None):
+        """Runs a file on the priority lane, with the other files paused until the lane is empty."""
+        return self.process_job(file_path, threads, priority=True)
+
+    @contextmanager
+    def preempt(self, priority):
+        """Pauses the other files while a priority file runs; does nothing for the others.
+
+        Entered only once the priority file has its scratch space: the paused
+        files keep theirs, so waiting for it with them paused could last forever.
+        """
+        if not priority:
+            yield
+            return
+        with self.lock:
+            self.preempting += 1
+            others = [control for control, (_, urgent) in self.controls.items() if not urgent]
+        for control in others:
+            control.pause()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.preempting -= 1
+                others = [control for control, (_, urgent) in self.controls.items()
+                          if not urgent and not self.preempting and not self.paused]
+            for control in others:
+                control.resume()
+
+    def process_job(self, file_path, threads=None, priority=False):
+        """Runs process() for one queued file, recording its stages in the job queue and the metrics."""
+        control = Control()
+        with self.lock:
+            if self.cancelled:
+                raise Cancelled()
+            if self.paused or (self.preempting and not priority):
+                control.pause()
+            self.controls[control] = (file_path, priority)
+        self.emit("started", file_path)
+        try:
+            with progress_listener(lambda block: self.encode_progress(file_path, block)), controlled(control), \
+                    self.job_queue.job(file_path) as job, metrics.recording(self.recorder, file_path):
+                result = self.process(file_path, threads, job, priority)
+        except Cancelled:
+            self.emit("cancelled", file_path)
+            raise
+        except Exception as e:
+            self.emit("failed", file_path, error=e)
+            raise
+        finally:
+            with self.lock:
+                self.durations.pop(file_path, None)
+                self.controls.pop(control, None)
+            if self.budget is not None:
+                self.budget.finish(file_path)
+            if self.metrics_file:
+                self.recorder.write_prometheus(self.metrics_file)
+        self.emit("done", file_path, result=result)
+        return result
+
+    def encode_progress(self, file_path, block):
+        seconds = progress_seconds(block)
+        with self.lock:
+            duration = self.durations.get(file_path)
+        self.emit("progress", file_path,
+                  fraction=min(seconds / duration, 1.0) if seconds and duration else 0.0,
+                  fps=progress_fps(block) or 0.0, speed=progress_speed(block) or 0.0)
+
+    def discord_copies(self, file_path, fingerprint, files, work_dir, threads=None, info=None, copy_audio=False,
+                       preset=DEFAULT_PRESET):
+        """Creates the Discord copies, files mapping each size cap to its destination. Returns {cap: fits}.
+
+        Cached and already existing copies are reused. Compression attempts
+        are written to work_dir, only the copies that fit are moved into place.
+        """
+        name = os.path.basename(file_path)
+        done = {}
+        for max_size_mb, discord_file in files.items():
+            os.makedirs(os.path.dirname(discord_file), exist_ok=True)
+            if self.cached_copy(file_path, fingerprint, max_size_mb, discord_file, preset):
+                self.log(f"Reused cached Discord copy: {os.path.relpath(discord_file, self.output_dir)}")
+                done[max_size_mb] = True
+            elif os.path.exists(discord_file) and 0 < compress.size_mb(discord_file) <= max_size_mb:
+                self.log(f"Discord copy already exists: {os.path.relpath(discord_file, self.output_dir)}")
+                # Nothing says what preset made it, so only a job that would settle for the fastest reuses it
+                self.cache_copy(file_path, fingerprint, max_size_mb, discord_file, PRESETS[0])
+                done[max_size_mb] = True
+
+        missing = {max_size_mb: os.path.join(work_dir, f"discord_{max_size_mb:g}.mp4")
+                   for max_size_mb in files if max_size_mb not in done}
+        if not missing:
+            return done
+        self.status(f"Compressing: {name}")
+        self.log(f"Compressing for Discord: {name}")
+        compressed = compress.compress_ladder(file_path, missing, info, log=self.log, threads=threads,
+                                              chunked=self.chunked, copy_audio=copy_audio, preset=preset)
+        for max_size_mb, fits in compressed.items():
+            if fits:
+                move_into_place(missing[max_size_mb], files[max_size_mb])
+                self.cache_copy(file_path, fingerprint, max_size_mb, files[max_size_mb], preset)
+            done[max_size_mb] = fits
+        return done
+
+    def process(self, file_path, threads=None, job=None, priority=False):
+        """Re-encodes a video to H.264 if needed and makes its Discord copy. Returns a Result.
+
+        Waits for scratch space first when the running jobs have taken it; a
+        priority file pauses the others only once it has its own.
+        With a budget, the preset is picked here and the encode time measured.
+        """
+        job = job or jobs.Job(file_path)
+        name = os.path.basename(file_path)
+        self.status(f"Checking: {name}")
+        processed, fingerprint = self.index.check(file_path)
+        if processed and not (job.master_done or self.redo):
+            copies = self.duplicate_copies(file_path, fingerprint)
+            return Result(file_path, skipped=not copies, discord_file=copies.get(self.max_size_mb), copies=copies)
+
+        job.set_state(jobs.PROBING)
+        info = probe_video(file_path, self.index)
+        with self.lock:
+            self.durations[file_path] = info.duration if info else None
+        self.log(f"Processing: {name} (Codec: {info.codec if info else ''})")
+
+        preset = DEFAULT_PRESET
+        if self.budget is not None:
+            preset = self.budget.pick()
+            self.log(f"Preset: {self.budget.describe(preset)}")
+        encodes = []
+
+        def on_run(cmd, returncode, seconds):
+            # Files that only needed a remux or a cached copy say nothing about encode speed
+            if "libx264" in cmd:
+                encodes.append(seconds)
+
+        needed = jobs.projected_bytes(file_path, info, self.tiers, self.chunked)
+        with self.scratch.job(needed, log=self.log) as work_dir, self.preempt(priority), run_listener(on_run):
+            started = time.perf_counter()
+            result = self.convert(file_path, fingerprint, info, processed, job, work_dir, threads, preset)
+        if self.budget is not None and encodes:
+            self.budget.finish(file_path, preset, time.perf_counter() - started)
+        return result
+
+    def convert(self, file_path, fingerprint, info, processed, job, work_dir, threads=None, preset=DEFAULT_PRESET):
+        """The part of process() that writes files, with every intermediate in work_dir."""
+        name = os.path.basename(file_path)
+        duration = info.duration if info else None
+        plan = plan_streams(info)
+        result = Result(file_path)
+        # Resumed and redone files already have their master, only the Discord copy is left
+        master_ready = processed
+        own_master = False
+        if master_ready:
+            self.log(f"Already converted: {name}, checking the Discord copy")
+        if plan.skip and not master_ready:
+            self.index.mark_processed(file_path, fingerprint)
+            self.log(f"Skipping re-encode (already H.264): {name}")
+            master_ready = True
+
+        master_file = os.path.join(work_dir, "master.mp4")
+        work_copy = os.path.join(work_dir, "discord.mp4")
+        compressed = None
+        if not master_ready:
+            job.set_state(jobs.ENCODING)
+
+        # Compatible streams in the wrong container only need a remux
+        if plan.remux and not master_ready:
+            self.status(f"Remuxing: {name}")
+            self.log(f"Remuxing to MP4 without re-encoding: {name}")
+            if remux_to_mp4(file_path, master_file, plan.copy_audio, duration):
+                mp4_path = remuxed_path(file_path)
+                if mp4_path:
+                    move_into_place(master_file, mp4_path)
+                    os.remove(file_path)
+                    file_path, name = mp4_path, os.path.basename(mp4_path)
+                    job.rename(file_path)
+                else:
+                    move_into_place(master_file, file_path)
+                result.reencoded = True
+                self.index.mark_processed(file_path, fingerprint)
+                master_ready = own_master = True
+            else:
+                self.log(f"Remux failed, re-encoding instead: {name}")
+
+        if not master_ready:
+            # Large files get the master and the Discord copy from one decode
+            if self.fused and os.path.getsize(file_path) > self.max_bytes:
+                self.status(f"Converting and compressing: {name}")
+                self.log(f"Re-encoding to H.264 and compressing for Discord together: {name}")
+                compressed = compress.compress_fused(file_path, master_file, work_copy,
+                                                     max_size_mb=self.max_size_mb, info=info, log=self.log,
+                                                     threads=threads, chunked=self.chunked,
+                                                     copy_audio=plan.copy_audio, preset=preset)
+
+            if not os.path.exists(master_file):
+                if compressed is not None:
+                    self.log(f"Fused encode failed, re-encoding the master on its own: {name}")
+                self.status(f"Converting: {name}")
+                self.log(f"Re-encoding to H.264: {name}")
+                compress.encode_master(file_path, master_file, threads, duration=duration, chunked=self.chunked,
+                                       log=self.log, copy_audio=plan.copy_audio, preset=preset)
+
+            # The master replaces the source, so it has to be whole
+            if os.path.exists(master_file) and is_complete(master_file, duration):
+                move_into_place(master_file, file_path)
+                result.reencoded = True
+                self.index.mark_processed(file_path, fingerprint)
+                master_ready = own_master = True
+            elif os.path.exists(master_file):
+                self.log(f"Error: the re-encoded {name} is incomplete, keeping the original")
+                os.remove(master_file)
+
+        # Only caps the file doesn't fit yet need a Discord copy; a fused one that isn't needed goes with work_dir
+        size = os.path.getsize(file_path)
+        files = {max_size_mb: self.copy_path(name, max_size_mb) for max_size_mb in self.tiers
+                 if size > max_size_mb * 1024 * 1024}
+        copies = {}
+        if compressed and self.max_size_mb in files:
+            os.makedirs(os.path.dirname(files[self.max_size_mb]), exist_ok=True)
+            move_into_place(work_copy, files[self.max_size_mb])
+            self.cache_copy(file_path, fingerprint, self.max_size_mb, files[self.max_size_mb], preset)
+            copies[self.max_size_mb] = True
+        rest = {max_size_mb: path for max_size_mb, path in files.items() if max_size_mb not in copies}
+        if rest:
+            job.set_state(jobs.COMPRESSING)
+            # Our own masters always carry audio that can be copied
+            copies.update(self.discord_copies(file_path, fingerprint, rest, work_dir, threads, info,
+                                              copy_audio=own_master or plan.copy_audio, preset=preset))
+
+        for max_size_mb, fits in sorted(copies.items()):
+            discord_file = files[max_size_mb]
+            if fits:
+                result.copies[max_size_mb] = discord_file
+                self.log(f"Created: {os.path.relpath(discord_file, self.output_dir)} "
+                         f"({os.path.getsize(discord_file) / (1024 * 1024):.2f} MB)\n")
+            else:
+                result.failed = True
+                self.log(f"Failed to compress under {max_size_mb:g} MB: {name}\n")
+        result.discord_file = result.copies.get(self.max_size_mb)
+        result.path = file_path
+        return result
+
+    def summary(self):
+        """Returns the per-stage summary of everything run so far, as lines of text."""
+        lines = ["Stage summary:", *self.recorder.summary()]
+        if self.events_path:
+            lines.append(f"Per-file events: {self.events_path}")
+        return lines
+
+    def running_controls(self, file_path=None):
+        with self.lock:
+            return [control for control, (path, _) in self.controls.items() if file_path in (None, path)]
+
+    def cancel(self, file_path=None):
+        """Stops one running file, or everything: the running files and all that haven't started.
+
+        Their ffmpeg processes are killed and their scratch workspaces removed;
+        the job queue keeps them unfinished, so they resume on the next run.
+        """
+        if file_path is None:
+            with self.lock:
+                self.cancelled = True
+        for control in self.running_controls(file_path):
+            control.cancel()
+
+    def pause(self, file_path=None):
+        """Pauses one running file, or all of them and the ones that start later.
+
+        Returns False where processes can't be paused (Windows).
+        """
+        if file_path is None:
+            with self.lock:
+                self.paused = True
+        for control in self.running_controls(file_path):
+            control.pause()
+        return PAUSE_SUPPORTED
+
+    def resume(self, file_path=None):
+        """Resumes what pause() stopped. Files that a priority file preempted stay paused until it is done."""
+        if file_path is None:
+            with self.lock:
+                self.paused = False
+        with self.lock:
+            controls = [control for control, (path, priority) in self.controls.items()
+                        if (file_path is None or path == file_path) and (priority or not self.preempting)]
+        for control in controls:
+            control.resume()
+
+    def close(self, wait=True):
+        """Stops the background workers, waiting for running files unless wait is False, and closes the databases."""
+        if self.priority_lane is not None:
+            self.priority_lane.shutdown(wait=wait)
+        if self.workers is not None:
+            self.workers.shutdown(wait=wait)
+        if self.metrics_file:
+            self.recorder.write_prometheus(self.metrics_file)
+        self.recorder.close()
+        if self.output_cache is not None:
+            self.output_cache.close()
+        self.job_queue.close()
+        self.index.close()
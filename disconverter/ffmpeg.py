@@ -0,0 +1,311 @@
+"""Small helpers around the ffmpeg command line tool."""
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+_listeners = threading.local()
+
+# Pausing stops the processes with SIGSTOP; Windows has no such signal
+PAUSE_SUPPORTED = hasattr(signal, "SIGSTOP")
+KILL_SIGNAL = getattr(signal, "SIGKILL", signal.SIGTERM)  # SIGTERM terminates the process on Windows
+
+
+def send(process, sig):
+    """Signals a child process without reaping it.
+
+    Popen.send_signal() and kill() poll() first, which can reap a child that
+    just exited; reap() then fails in os.wait4 and a finished job looks like
+    it failed. Only reap() collects the children started here.
+    """
+    try:
+        os.kill(process.pid, sig)
+    except OSError:
+        pass  # already gone
+
+
+class Cancelled(Exception):
+    """Raised in a job whose Control was cancelled, once its running process is gone."""
+
+
+class Control:
+    """Cancels, pauses and resumes the ffmpeg/ffprobe processes of one job, from any thread.
+
+    Processes are started through it by spawn() while it is set with
+    controlled(). A paused job's processes are stopped with SIGSTOP and new
+    ones wait until it is resumed; cancelling kills them and makes the job's
+    next wait() or spawn() raise Cancelled.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.cancelled = False
+        self.running = threading.Event()
+        self.running.set()
+
+    @property
+    def paused(self):
+        return not self.running.is_set()
+
+    def start(self, cmd, **kwargs):
+        self.running.wait()
+        with self.lock:
+            if self.cancelled:
+                raise Cancelled()
+            process = subprocess.Popen(cmd, **kwargs)
+            self.processes.add(process)
+            if self.paused:
+                send(process, signal.SIGSTOP)
+        return process
+
+    def finished(self, process):
+        with self.lock:
+            self.processes.discard(process)
+            if self.cancelled:
+                raise Cancelled()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for process in self.processes:
+                send(process, KILL_SIGNAL)
+        # A paused job wakes up to notice
+        self.running.set()
+
+    def pause(self):
+        """Stops the running processes. Returns False where that isn't supported."""
+        if not PAUSE_SUPPORTED:
+            return False
+        with self.lock:
+            if not self.cancelled:
+                self.running.clear()
+                for process in self.processes:
+                    send(process, signal.SIGSTOP)
+        return True
+
+    def resume(self):
+        with self.lock:
+            self.running.set()
+            if PAUSE_SUPPORTED:
+                for process in self.processes:
+                    send(process, signal.SIGCONT)
+
+
+@contextmanager
+def controlled(control):
+    """Runs the processes started on this thread under control."""
+    previous = getattr(_listeners, "control", None)
+    _listeners.control = control
+    try:
+        yield
+    finally:
+        _listeners.control = previous
+
+
+def current_control():
+    return getattr(_listeners, "control", None)
+
+
+def spawn(cmd, **kwargs):
+    """subprocess.Popen under this thread's Control, if any. Pair it with wait()."""
+    control = current_control()
+    if control is None:
+        return subprocess.Popen(cmd, **kwargs)
+    return control.start(cmd, **kwargs)
+
+
+@contextmanager
+def progress_listener(callback):
+    """Sends the progress blocks of every ffmpeg run on this thread to callback."""
+    previous = getattr(_listeners, "progress", None)
+    _listeners.progress = callback
+    try:
+        yield
+    finally:
+        _listeners.progress = previous
+
+
+@contextmanager
+def run_listener(callback):
+    """Calls callback(cmd, returncode, seconds) after every ffmpeg run on this thread.
+
+    returncode is None for runs that were stopped through on_progress. Like
+    usage_listener, an outer listener keeps getting the runs too.
+    """
+    previous = getattr(_listeners, "finished", None)
+
+    def chained(cmd, returncode, seconds):
+        callback(cmd, returncode, seconds)
+        if previous is not None:
+            previous(cmd, returncode, seconds)
+
+    _listeners.finished = chained
+    try:
+        yield
+    finally:
+        _listeners.finished = previous
+
+
+def current_run_listener():
+    return getattr(_listeners, "finished", None)
+
+
+def set_run_listener(callback):
+    _listeners.finished = callback
+
+
+@contextmanager
+def usage_listener(callback):
+    """Calls callback(cpu_seconds, max_rss_bytes) for every child process reaped on this thread.
+
+    An outer listener keeps getting the usage too, so nested listeners each
+    see everything that ran inside them.
+    """
+    previous = getattr(_listeners, "usage", None)
+
+    def chained(cpu_seconds, max_rss):
+        callback(cpu_seconds, max_rss)
+        if previous is not None:
+            previous(cpu_seconds, max_rss)
+
+    _listeners.usage = chained
+    try:
+        yield
+    finally:
+        _listeners.usage = previous
+
+
+def current_usage_listener():
+    return getattr(_listeners, "usage", None)
+
+
+def set_usage_listener(callback):
+    _listeners.usage = callback
+
+
+def wait(process):
+    """Waits for a child process and returns its exit code.
+
+    Where os.wait4 exists the child's own CPU time and peak memory are passed
+    to the usage listener; unlike RUSAGE_CHILDREN deltas they stay correct
+    with other encodes running in parallel. Raises Cancelled if the process
+    was started by spawn() under a Control that has been cancelled.
+    """
+    try:
+        return reap(process)
+    finally:
+        control = current_control()
+        if control is not None:
+            control.finished(process)
+
+
+def reap(process):
+    if not hasattr(os, "wait4"):
+        return process.wait()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    listener = getattr(_listeners, "usage", None)
+    if listener is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        max_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        listener(usage.ru_utime + usage.ru_stime, max_rss)
+    return process.returncode
+
+
+def run_ffmpeg(args, on_progress=None):
+    """Runs ffmpeg with the given arguments and returns its exit code.
+
+    See execute for on_progress. Runs are reported to the run_listener, if any.
+    """
+    started = time.perf_counter()
+    returncode = execute(args, on_progress)
+    finished = getattr(_listeners, "finished", None)
+    if finished is not None:
+        finished(["ffmpeg", *args], returncode, time.perf_counter() - started)
+    return returncode
+
+
+def output_ok(returncode, output_file):
+    """Returns True if ffmpeg exited cleanly and left a non-empty output_file.
+
+    A failed run's partial output is removed, so nothing later mistakes it
+    for a result.
+    """
+    if returncode == 0 and os.path.exists(output_file) and os.path.getsize(output_file) > 0:
+        return True
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    return False
+
+
+def execute(args, on_progress=None):
+    """Runs ffmpeg with the given arguments and returns its exit code.
+
+    With on_progress, ffmpeg reports through -progress and the callback gets
+    each block as a dict (frame, total_size, out_time_us, speed, ...). If the
+    callback returns False the encode is killed and None is returned. A
+    listener registered with progress_listener also gets every block.
+    """
+    listener = getattr(_listeners, "progress", None)
+    if on_progress is None and listener is None:
+        cmd = ["ffmpeg", "-y", *args]
+        process = spawn(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return wait(process)
+
+    cmd = ["ffmpeg", "-y", "-nostats", "-progress", "pipe:1", *args]
+    process = spawn(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    block = {}
+    for line in process.stdout:
+        key, _, value = line.strip().partition("=")
+        block[key] = value
+        if key != "progress":
+            continue
+        if listener is not None:
+            listener(block)
+        if on_progress is not None and on_progress(block) is False:
+            send(process, KILL_SIGNAL)
+            wait(process)
+            return None
+        block = {}
+    return wait(process)
+
+
+def progress_seconds(block):
+    """Returns the media time an ffmpeg progress block has reached, in seconds."""
+    try:
+        return int(block.get("out_time_us", "")) / 1_000_000
+    except ValueError:
+        return None
+
+
+def progress_bytes(block):
+    """Returns how many bytes ffmpeg has written so far according to a progress block."""
+    try:
+        return int(block.get("total_size", ""))
+    except ValueError:
+        return None
+
+
+def progress_fps(block):
+    """Returns the encode speed in frames per second from a progress block."""
+    try:
+        return float(block.get("fps", ""))
+    except ValueError:
+        return None
+
+
+def progress_speed(block):
+    """Returns the realtime multiplier from a progress block, e.g. 2.5 for "2.5x"."""
+    try:
+        return float(block.get("speed", "").strip().rstrip("x"))
+    except ValueError:
+        return None
+
+
+def thread_args(threads):
+    """Returns the ffmpeg arguments that cap encoder threads, if any."""
+    return ["-threads", str(threads)] if threads else []
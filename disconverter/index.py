@@ -0,0 +1,242 @@
+"""Persistent index of processed videos.
+
+Files are keyed on path, size, mtime and inode, so an unchanged file is
+recognised without reading it, and its ffprobe metadata is cached with
+it so repeat runs never probe it again. New or changed files get a sampled
+fingerprint (size, head and tail) and are only hashed in full when that
+fingerprint matches a different file, or while the old MD5 list from
+processed_videos.txt is still being migrated. A full MD5 is cached with the
+file's stat like the probe, and the migration ends with the first full
+batch: old MD5s that none of its files matched are dropped.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+
+from . import metrics
+from .probe import VideoInfo
+
+DB_PATH = "processed_videos.db"
+LEGACY_PATH = "processed_videos.txt"
+SAMPLE_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    probe TEXT,
+    md5 TEXT
+);
+CREATE TABLE IF NOT EXISTS processed (
+    fingerprint TEXT PRIMARY KEY,
+    path TEXT,
+    full_md5 TEXT
+);
+CREATE TABLE IF NOT EXISTS legacy_md5 (
+    md5 TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def sample_fingerprint(file_path, size=None):
+    """Returns a fast fingerprint built from the size, head and tail of the file."""
+    if size is None:
+        size = os.path.getsize(file_path)
+    with metrics.stage("hash", method="sample", bytes_in=min(size, 2 * SAMPLE_SIZE)):
+        hasher = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(file_path, 'rb') as f:
+            hasher.update(f.read(SAMPLE_SIZE))
+            if size > SAMPLE_SIZE:
+                f.seek(max(SAMPLE_SIZE, size - SAMPLE_SIZE))
+                hasher.update(f.read(SAMPLE_SIZE))
+    return hasher.hexdigest()
+
+
+def full_md5(file_path):
+    """Returns the MD5 of the whole file, as the old processed_videos.txt did."""
+    with metrics.stage("hash", method="md5", bytes_in=metrics.file_size(file_path)):
+        hasher = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def stat_key(st):
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class FileIndex:
+    """SQLite index of seen files and processed content, safe to share between threads."""
+
+    def __init__(self, db_path=DB_PATH, legacy_path=LEGACY_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.upgrade_schema()
+        self.migrate_legacy(legacy_path)
+        self.has_legacy = self.conn.execute("SELECT 1 FROM legacy_md5 LIMIT 1").fetchone() is not None
+
+    def upgrade_schema(self):
+        """Adds columns introduced after an index file was first created."""
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(files)")}
+        for column in ("probe", "md5"):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE files ADD COLUMN {column} TEXT")
+        self.conn.commit()
+
+    def migrate_legacy(self, legacy_path):
+        """Imports the MD5 list from processed_videos.txt once."""
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_migrated'").fetchone():
+            return
+        if os.path.exists(legacy_path):
+            with open(legacy_path, "r") as f:
+                hashes = {line.strip() for line in f if line.strip()}
+            self.conn.executemany("INSERT OR IGNORE INTO legacy_md5 (md5) VALUES (?)",
+                                  ((h,) for h in hashes))
+        self.conn.execute("INSERT INTO meta (key, value) VALUES ('legacy_migrated', '1')")
+        self.conn.commit()
+
+    def fingerprint(self, file_path):
+        """Returns (fingerprint, unchanged) for a file, reading it only if its stat changed."""
+        st = os.stat(file_path)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, inode, fingerprint FROM files WHERE path = ?", (file_path,)
+            ).fetchone()
+        if row and tuple(row[:3]) == stat_key(st):
+            return row[3], True
+
+        fingerprint = sample_fingerprint(file_path, st.st_size)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, fingerprint) VALUES (?, ?, ?, ?, ?)",
+                (file_path, *stat_key(st), fingerprint)
+            )
+            self.conn.commit()
+        return fingerprint, False
+
+    def check(self, file_path):
+        """Returns (processed, fingerprint) for a file.
+
+        The fingerprint is passed back to mark_processed once the file is done.
+        """
+        fingerprint, _ = self.fingerprint(file_path)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT path, full_md5 FROM processed WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+
+        if row:
+            if row[0] == file_path:
+                return True, fingerprint
+            # Asked again for the same file, the MD5s come from the files table
+            return self.confirm_collision(file_path, fingerprint, row[0], row[1]), fingerprint
+
+        if self.has_legacy:
+            md5 = self.file_md5(file_path)
+            with self.lock:
+                if self.conn.execute("SELECT 1 FROM legacy_md5 WHERE md5 = ?", (md5,)).fetchone():
+                    self.conn.execute("DELETE FROM legacy_md5 WHERE md5 = ?", (md5,))
+                    self.record(fingerprint, file_path, md5)
+                    self.conn.commit()
+                    return True, fingerprint
+        return False, fingerprint
+
+    def confirm_collision(self, file_path, fingerprint, known_path, known_md5):
+        """Full-hashes a file whose sampled fingerprint matches a different processed file."""
+        if known_md5 is None:
+            if not os.path.exists(known_path) or self.fingerprint(known_path)[0] != fingerprint:
+                # The original is gone or changed, the sample is all we have
+                return True
+            known_md5 = self.file_md5(known_path)
+            with self.lock:
+                self.conn.execute("UPDATE processed SET full_md5 = ? WHERE fingerprint = ?",
+                                  (known_md5, fingerprint))
+                self.conn.commit()
+        return self.file_md5(file_path) == known_md5
+
+    def file_md5(self, file_path):
+        """Returns the full MD5 of a file, hashing it only if its stat changed since the last time."""
+        self.fingerprint(file_path)
+        st = os.stat(file_path)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, inode, md5 FROM files WHERE path = ?", (file_path,)
+            ).fetchone()
+        if row and row[3] and tuple(row[:3]) == stat_key(st):
+            return row[3]
+        md5 = full_md5(file_path)
+        with self.lock:
+            self.conn.execute("UPDATE files SET md5 = ? WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                              (md5, file_path, *stat_key(st)))
+            self.conn.commit()
+        return md5
+
+    def retire_legacy(self, file_paths):
+        """Checks a batch against the old MD5 list, then drops the MD5s none of its files matched.
+
+        Re-encoded files never match their old MD5 again, so without this every
+        new file would be hashed in full for good. Does nothing once retired.
+        """
+        if not self.has_legacy:
+            return
+        for file_path in file_paths:
+            try:
+                self.check(file_path)
+            except OSError:
+                continue
+        with self.lock:
+            self.conn.execute("DELETE FROM legacy_md5")
+            self.conn.commit()
+        self.has_legacy = False
+
+    def record(self, fingerprint, file_path, md5=None):
+        self.conn.execute(
+            "INSERT OR IGNORE INTO processed (fingerprint, path, full_md5) VALUES (?, ?, ?)",
+            (fingerprint, file_path, md5)
+        )
+
+    def mark_processed(self, file_path, fingerprint):
+        """Records a file as processed, including its new content if it was re-encoded in place."""
+        current, _ = self.fingerprint(file_path)
+        with self.lock:
+            self.record(fingerprint, file_path)
+            if current != fingerprint:
+                self.record(current, file_path)
+            self.conn.commit()
+
+    def get_probe(self, file_path):
+        """Returns the cached VideoInfo for a file, or None if it changed or was never probed."""
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, inode, probe FROM files WHERE path = ?", (file_path,)
+            ).fetchone()
+        if not row or row[3] is None or tuple(row[:3]) != stat_key(st):
+            return None
+        return VideoInfo.from_json(row[3])
+
+    def set_probe(self, file_path, info):
+        """Caches a VideoInfo next to the file's fingerprint."""
+        self.fingerprint(file_path)
+        with self.lock:
+            self.conn.execute("UPDATE files SET probe = ? WHERE path = ?", (info.to_json(), file_path))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
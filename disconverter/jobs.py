@@ -0,0 +1,212 @@
+"""Persistent queue of the files in a batch, so an interrupted run resumes where it stopped.
+
+Every job moves through pending, probing, encoding and compressing to done or
+failed, and each stage is written to the index database before it starts. The
+next run picks interrupted jobs up first: a job that was compressing already
+has its master, so only the Discord copy is made again. Half-written
+*.temp.mp4 files from a crash are removed on startup.
+"""
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .ffmpeg import Cancelled
+from .index import DB_PATH
+from .scratch import TEMP_SUFFIX
+from .streams import plan_streams
+
+PENDING = "pending"
+PROBING = "probing"
+ENCODING = "encoding"
+COMPRESSING = "compressing"
+DONE = "done"
+FAILED = "failed"
+ACTIVE = (PROBING, ENCODING, COMPRESSING)
+
+ORDERS = ("listed", "shortest", "savings")
+MASTER_BITS_PER_PIXEL = 0.1  # rough size of a CRF 18 H.264 master, for the savings estimate
+DEFAULT_FPS = 30.0
+PROBE_WORKERS = 4  # ffprobe and fingerprint reads for sorting are I/O bound
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    path TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    error TEXT,
+    updated REAL
+);
+"""
+
+
+def remove_orphans(directory):
+    """Deletes temp files left behind by an interrupted encode. Returns their names."""
+    removed = []
+    for name in os.listdir(directory):
+        if name.endswith(TEMP_SUFFIX):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                continue
+            removed.append(name)
+    return removed
+
+
+def estimated_savings(file_path, info):
+    """Returns roughly how many bytes re-encoding a file to the H.264 master frees."""
+    if info is None or plan_streams(info).skip:
+        return 0
+    size = info.size or os.path.getsize(file_path)
+    video = info.video
+    if not info.duration or not video or not video.width or not video.height:
+        return size
+    pixels_per_second = video.width * video.height * (video.fps or DEFAULT_FPS)
+    master_bytes = pixels_per_second * MASTER_BITS_PER_PIXEL / 8 * info.duration
+    return max(size - master_bytes, 0)
+
+
+def projected_bytes(file_path, info, caps_mb, chunked=False):
+    """Returns roughly how much scratch space processing a file takes at its peak.
+
+    That is the master and one compression attempt per size cap the file
+    doesn't fit yet; a chunked encode also holds the split source and the
+    encoded segments before they are joined.
+    """
+    size = (info.size if info else None) or os.path.getsize(file_path)
+    copy_bytes = sum(cap * 1024 * 1024 for cap in caps_mb if size > cap * 1024 * 1024)
+    if info is not None and plan_streams(info).skip:
+        return copy_bytes
+    master_bytes = size - estimated_savings(file_path, info)
+    if chunked:
+        return size + 2 * master_bytes + copy_bytes
+    return master_bytes + copy_bytes
+
+
+def order_key(policy, file_path, info):
+    if policy == "shortest":
+        return info.duration if info and info.duration else float("inf")
+    if policy == "savings":
+        return -estimated_savings(file_path, info)
+    return 0
+
+
+class Job:
+    """One file's place in the queue, handed to Engine.process to record its stages.
+
+    A Job without a queue only tracks its path, so callers can always pass one.
+    """
+
+    def __init__(self, path, queue=None, state=PENDING):
+        self.path = path
+        self.queue = queue
+        self.state = state
+        self.resumed_state = state if state in ACTIVE else None
+
+    @property
+    def master_done(self):
+        """True if the last run had already moved on to the Discord copy."""
+        return self.resumed_state == COMPRESSING
+
+    def set_state(self, state):
+        self.state = state
+        if self.queue is not None:
+            self.queue.set_state(self.path, state)
+
+    def rename(self, new_path):
+        """Follows the file when it gets a new name, e.g. after a remux to .mp4."""
+        if self.queue is not None:
+            self.queue.rename(self.path, new_path)
+        self.path = new_path
+
+
+class JobQueue:
+    """SQLite-backed job states, safe to share between threads."""
+
+    def __init__(self, db_path=DB_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def add(self, file_paths):
+        """Queues files for this run. Jobs an earlier run left unfinished keep their state."""
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO jobs (path, state, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET state = excluded.state, error = NULL, updated = excluded.updated "
+                "WHERE jobs.state IN (?, ?)",
+                ((path, PENDING, now, DONE, FAILED) for path in file_paths)
+            )
+            self.conn.commit()
+
+    def state(self, file_path):
+        with self.lock:
+            row = self.conn.execute("SELECT state FROM jobs WHERE path = ?", (file_path,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, file_path, state, error=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jobs (path, state, error, updated) VALUES (?, ?, ?, ?)",
+                (file_path, state, error, time.time())
+            )
+            self.conn.commit()
+
+    def rename(self, old_path, new_path):
+        with self.lock:
+            self.conn.execute("DELETE FROM jobs WHERE path = ?", (new_path,))
+            self.conn.execute("UPDATE jobs SET path = ? WHERE path = ?", (new_path, old_path))
+            self.conn.commit()
+
+    def unfinished(self, directory=None):
+        """Returns the paths of pending and interrupted jobs whose files still exist."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path FROM jobs WHERE state NOT IN (?, ?)", (DONE, FAILED)
+            ).fetchall()
+        return [row[0] for row in rows
+                if os.path.exists(row[0]) and (directory is None or os.path.dirname(row[0]) == directory)]
+
+    def ordered(self, file_paths, policy="listed", probe=None):
+        """Returns the unfinished file_paths in processing order.
+
+        Interrupted jobs come first, then the pending ones sorted by policy:
+        "listed" keeps the given order, "shortest" runs the shortest videos
+        first, "savings" the ones re-encoding shrinks the most. probe(path)
+        returns the VideoInfo the sorting is based on; files are probed a few
+        at a time.
+        """
+        with self.lock:
+            states = dict(self.conn.execute("SELECT path, state FROM jobs").fetchall())
+        resumed = [path for path in file_paths if states.get(path) in ACTIVE]
+        pending = [path for path in file_paths if states.get(path) == PENDING]
+        if policy != "listed" and probe is not None:
+            with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+                infos = dict(zip(pending, executor.map(probe, pending)))
+            keys = {path: order_key(policy, path, infos[path]) for path in pending}
+            pending.sort(key=keys.get)
+        return resumed + pending
+
+    @contextmanager
+    def job(self, file_path):
+        """Yields the Job for a file and marks it done, or failed if the block raises.
+
+        A cancelled job keeps the stage it was in, so the next run resumes it.
+        """
+        job = Job(file_path, self, self.state(file_path) or PENDING)
+        try:
+            yield job
+        except Cancelled:
+            raise
+        except Exception as e:
+            self.set_state(job.path, FAILED, str(e))
+            raise
+        self.set_state(job.path, DONE)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
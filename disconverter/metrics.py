@@ -0,0 +1,207 @@
+"""Structured per-file stage events, for finding where the time actually goes.
+
+Work on a file runs inside recording(metrics, file_path); every stage() in
+it (hashing, probing, re-encoding, each compress attempt) then writes one
+JSON line with its wall time, this thread's CPU time, the CPU time and peak
+memory of the ffmpeg/ffprobe processes it ran, bytes in and out, the CRF or
+bitrate used and the outcome. Outside recording() stages cost nothing. At the
+end of a batch the events are summarised per stage and can be exported as a
+Prometheus text-format file.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .ffmpeg import (Cancelled, current_run_listener, current_usage_listener, set_run_listener, set_usage_listener,
+                     usage_listener)
+
+EVENTS_PATH = "disconvert_events.jsonl"
+
+_current = threading.local()
+
+
+class Metrics:
+    """Collects stage events and appends them to a JSONL file, safe to share between threads."""
+
+    def __init__(self, events_path=EVENTS_PATH):
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.events = []
+        self.file = open(events_path, "a") if events_path else None
+
+    def record(self, event):
+        with self.lock:
+            self.events.append(event)
+            if self.file is not None:
+                self.file.write(json.dumps(event) + "\n")
+                self.file.flush()
+
+    def totals(self):
+        """Returns per-stage totals: {stage: {count, wall_s, cpu_s, child_cpu_s, max_rss, bytes_out, outcomes}}."""
+        totals = {}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            total = totals.setdefault(event["stage"], {
+                "count": 0, "wall_s": 0.0, "cpu_s": 0.0, "child_cpu_s": 0.0, "max_rss": 0, "bytes_out": 0,
+                "outcomes": {},
+            })
+            total["count"] += 1
+            total["wall_s"] += event["wall_s"]
+            total["cpu_s"] += event["cpu_s"]
+            total["child_cpu_s"] += event["child_cpu_s"]
+            total["max_rss"] = max(total["max_rss"], event["max_rss"])
+            total["bytes_out"] += event.get("bytes_out") or 0
+            outcome = event.get("outcome", "ok")
+            total["outcomes"][outcome] = total["outcomes"].get(outcome, 0) + 1
+        return totals
+
+    def summary(self):
+        """Returns the per-stage totals as lines of a table."""
+        totals = self.totals()
+        lines = [f"{'stage':<10} {'runs':>5} {'wall s':>9} {'cpu s':>8} {'child cpu s':>12} {'peak MB':>8}  outcomes"]
+        for stage, total in sorted(totals.items(), key=lambda item: -item[1]["wall_s"]):
+            outcomes = ", ".join(f"{name} {count}" for name, count in sorted(total["outcomes"].items()))
+            lines.append(
+                f"{stage:<10} {total['count']:>5} {total['wall_s']:>9.1f} {total['cpu_s']:>8.1f} "
+                f"{total['child_cpu_s']:>12.1f} {total['max_rss'] / (1024 * 1024):>8.0f}  {outcomes}"
+            )
+        return lines
+
+    def write_prometheus(self, path):
+        """Writes the per-stage totals in the Prometheus text exposition format."""
+        totals = self.totals()
+        metrics = [
+            ("disconvert_stage_runs_total", "counter", "Stage runs by outcome."),
+            ("disconvert_stage_wall_seconds_total", "counter", "Wall time spent in the stage."),
+            ("disconvert_stage_cpu_seconds_total", "counter", "CPU time of the worker thread in the stage."),
+            ("disconvert_stage_child_cpu_seconds_total", "counter", "CPU time of ffmpeg/ffprobe in the stage."),
+            ("disconvert_stage_max_rss_bytes", "gauge", "Peak memory of a single ffmpeg/ffprobe process."),
+            ("disconvert_stage_output_bytes_total", "counter", "Bytes written by the stage."),
+        ]
+        lines = []
+        for name, kind, help_text in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for stage, total in sorted(totals.items()):
+                if name == "disconvert_stage_runs_total":
+                    for outcome, count in sorted(total["outcomes"].items()):
+                        lines.append(f'{name}{{stage="{stage}",outcome="{outcome}"}} {count}')
+                    continue
+                value = {
+                    "disconvert_stage_wall_seconds_total": total["wall_s"],
+                    "disconvert_stage_cpu_seconds_total": total["cpu_s"],
+                    "disconvert_stage_child_cpu_seconds_total": total["child_cpu_s"],
+                    "disconvert_stage_max_rss_bytes": total["max_rss"],
+                    "disconvert_stage_output_bytes_total": total["bytes_out"],
+                }[name]
+                lines.append(f'{name}{{stage="{stage}"}} {round(value, 3)}')
+        # Written whole and renamed, so a scraper never reads half a file
+        with self.write_lock:
+            temp_path = path + ".tmp"
+            with open(temp_path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(temp_path, path)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+@contextmanager
+def recording(metrics, file_path):
+    """Sends the stages run on this thread to metrics, as events of file_path."""
+    previous = getattr(_current, "target", None)
+    _current.target = (metrics, os.path.basename(file_path)) if metrics is not None else None
+    try:
+        yield
+    finally:
+        _current.target = previous
+
+
+def carry(fn):
+    """Wraps fn so it records into the calling thread's file and stage when run on another thread.
+
+    Its ffmpeg runs are reported to the calling thread's run listener as well.
+    """
+    target = getattr(_current, "target", None)
+    usage = current_usage_listener()
+    runs = current_run_listener()
+
+    def wrapper(*args, **kwargs):
+        previous_target = getattr(_current, "target", None)
+        previous_usage = current_usage_listener()
+        previous_runs = current_run_listener()
+        _current.target = target
+        set_usage_listener(usage)
+        set_run_listener(runs)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.target = previous_target
+            set_usage_listener(previous_usage)
+            set_run_listener(previous_runs)
+
+    return wrapper
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+@contextmanager
+def stage(name, **fields):
+    """Times a stage of the current file and records it as an event.
+
+    Yields the event dict, so the block can fill in bytes_out, outcome and
+    anything else it learns along the way. An exception is recorded as the
+    outcome "error", a cancelled job as "cancelled", and passed on.
+    """
+    target = getattr(_current, "target", None)
+    if target is None:
+        yield {}
+        return
+    metrics, file_name = target
+    event = {"file": file_name, "stage": name, **fields}
+    lock = threading.Lock()
+    children = {"cpu_s": 0.0, "max_rss": 0}
+
+    def on_usage(cpu_seconds, max_rss):
+        with lock:
+            children["cpu_s"] += cpu_seconds
+            children["max_rss"] = max(children["max_rss"], max_rss)
+
+    started = time.perf_counter()
+    thread_started = time.thread_time()
+    try:
+        with usage_listener(on_usage):
+            yield event
+    except Cancelled:
+        event["outcome"] = "cancelled"
+        raise
+    except Exception as e:
+        event["outcome"] = "error"
+        event["error"] = str(e)
+        raise
+    finally:
+        event.setdefault("outcome", "ok")
+        event["wall_s"] = round(time.perf_counter() - started, 3)
+        event["cpu_s"] = round(time.thread_time() - thread_started, 3)
+        event["child_cpu_s"] = round(children["cpu_s"], 3)
+        event["max_rss"] = children["max_rss"]
+        event["time"] = round(time.time(), 3)
+        metrics.record(event)
+
+
+def set_output(event, path):
+    """Fills in bytes_out from path, marking the event "missing" if nothing was written."""
+    event["bytes_out"] = file_size(path)
+    if not event["bytes_out"]:
+        event["outcome"] = "missing"
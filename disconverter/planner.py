@@ -0,0 +1,129 @@
+"""Predicts the compressed size from short sample encodes and picks a CRF.
+
+A few segments spread across the file are encoded at a handful of CRFs. Their
+sizes are fitted to ln(size) = a + b * crf, which holds well for x264, scaled
+up to the full duration and searched by bisection for the lowest CRF that fits.
+The samples run at a fast preset; when the final encode uses a slower one,
+the samples are encoded once more at the middle CRF with it, and the ratio
+between the two scales the model.
+"""
+import math
+import os
+import shutil
+from dataclasses import dataclass
+
+from . import metrics, scratch
+from .budget import DEFAULT_PRESET, search_preset
+from .ffmpeg import output_ok, run_ffmpeg, thread_args
+
+SAMPLE_COUNT = 3
+SAMPLE_SECONDS = 4
+SAMPLE_CRFS = (23, 30, 37)
+MIN_CRF = 18
+MAX_CRF = 51
+SAFETY = 0.92  # aim a little under the cap, the model is only an estimate
+
+
+@dataclass
+class CrfModel:
+    a: float
+    b: float
+    scale: float  # full duration / sampled duration
+    audio_bytes: float  # the samples are encoded without audio
+    overhead: float  # container overhead, as a share of the output
+
+    def predict_bytes(self, crf):
+        video_bytes = math.exp(self.a + self.b * crf) * self.scale
+        return (video_bytes + self.audio_bytes) * (1 + self.overhead)
+
+    def predict_mb(self, crf):
+        return self.predict_bytes(crf) / (1024 * 1024)
+
+    def pick_crf(self, max_size_mb):
+        """Returns the lowest CRF predicted to fit, found by bisection."""
+        limit = max_size_mb * SAFETY
+        lo, hi = MIN_CRF, MAX_CRF
+        if self.predict_mb(hi) > limit:
+            return None
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.predict_mb(mid) <= limit:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def correct(self, actual_mb, predicted_mb):
+        """Rescales the video part of the model after a full encode missed the prediction."""
+        self.scale *= actual_mb / predicted_mb
+
+
+def sample_segments(duration):
+    """Returns (start, length) pairs spread evenly across the file."""
+    if duration <= SAMPLE_COUNT * SAMPLE_SECONDS:
+        return [(0.0, duration)]
+    step = duration / SAMPLE_COUNT
+    return [(step * i + (step - SAMPLE_SECONDS) / 2, SAMPLE_SECONDS) for i in range(SAMPLE_COUNT)]
+
+
+def fit(points):
+    """Least-squares fit of ln(size) against CRF. Returns (a, b)."""
+    xs = [crf for crf, _ in points]
+    ys = [math.log(size) for _, size in points]
+    n = len(points)
+    mean_x, mean_y = sum(xs) / n, sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    b = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    return mean_y - b * mean_x, b
+
+
+def build_model(input_file, duration, audio_kbps, overhead, threads=None, video_args=(), preset=DEFAULT_PRESET):
+    """Encodes the sample segments at each candidate CRF. Returns a CrfModel, or None.
+
+    video_args carries any scaling, so the samples match the final encode,
+    and preset is the preset of the final encode.
+    """
+    segments = sample_segments(duration)
+    sampled = sum(length for _, length in segments)
+    search = search_preset(preset)
+    calibrate = search != preset
+    with metrics.stage("plan", samples=len(segments) * (len(SAMPLE_CRFS) + calibrate), preset=search) as event:
+        points = sample_points(input_file, segments, threads, video_args, search)
+        ratio = 1.0
+        if points is not None and calibrate:
+            crf, fast_bytes = points[len(points) // 2]
+            final = sample_points(input_file, segments, threads, video_args, preset, crfs=(crf,))
+            if final is None:
+                points = None
+            else:
+                ratio = final[0][1] / fast_bytes
+                event["calibration"] = round(ratio, 3)
+        if points is None:
+            event["outcome"] = "failed"
+            return None
+
+    a, b = fit(points)
+    return CrfModel(a, b, duration / sampled * ratio, audio_kbps * 1000 / 8 * duration, overhead)
+
+
+def sample_points(input_file, segments, threads=None, video_args=(), preset=DEFAULT_PRESET, crfs=SAMPLE_CRFS):
+    """Returns (crf, total sample bytes) for each of crfs, or None if a sample failed."""
+    work_dir = scratch.mkdtemp(prefix="disconvert_")
+    points = []
+    try:
+        for crf in crfs:
+            total = 0
+            for i, (start, length) in enumerate(segments):
+                sample = os.path.join(work_dir, f"sample_{crf}_{i}.mp4")
+                returncode = run_ffmpeg([
+                    "-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", input_file,
+                    "-c:v", "libx264", "-preset", preset, "-crf", str(crf),
+                    *thread_args(threads), *video_args, "-an", sample
+                ])
+                if not output_ok(returncode, sample):
+                    return None
+                total += os.path.getsize(sample)
+            points.append((crf, max(total, 1)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return points
@@ -0,0 +1,171 @@
+"""Runs several files at once and splits the CPU cores between them.
+
+Given a prepare(file_path) step, the disk-bound work for upcoming files
+(fingerprinting, probing) runs on its own thread while the encoders are busy.
+It runs at most `lookahead` files ahead; once that many are prepared and
+waiting it blocks until an encoder takes one.
+"""
+import os
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+LOOKAHEAD = 2
+
+
+def default_jobs():
+    """Returns how many files to run at once on this machine by default."""
+    return max(1, (os.cpu_count() or 1) // 4)
+
+
+def threads_per_job(jobs):
+    """Returns the ffmpeg thread count for each of `jobs` concurrent files.
+
+    A single job returns None so ffmpeg keeps picking its own thread count.
+    """
+    if jobs <= 1:
+        return None
+    return max(1, (os.cpu_count() or 1) // jobs)
+
+
+def prepare_quietly(prepare, file_path):
+    """Runs a prepare step, leaving any error for process() to hit and report."""
+    try:
+        prepare(file_path)
+    except Exception:
+        pass
+
+
+def run_pool(file_paths, process, jobs=1, should_continue=None, on_done=None, on_error=None,
+             prepare=None, lookahead=LOOKAHEAD):
+    """Calls process(file_path, threads) for every path using `jobs` workers.
+
+    Files that haven't started yet are skipped once should_continue() returns
+    False. on_done(file_path, done_count) is called under a lock after each
+    file so callers can update counters without their own locking. Errors are
+    passed to on_error(file_path, exc) if given, otherwise re-raised.
+    With prepare, prepare(file_path) runs up to `lookahead` files ahead of
+    the workers, in order, so process() finds its inputs already cached.
+    Returns the number of files that were processed.
+    """
+    threads = threads_per_job(jobs)
+    jobs = max(1, jobs)
+    lock = threading.Lock()
+    done = 0
+
+    def running():
+        return should_continue is None or should_continue()
+
+    def work(file_path):
+        nonlocal done
+        if not running():
+            return
+        try:
+            process(file_path, threads)
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(file_path, e)
+        with lock:
+            done += 1
+            if on_done is not None:
+                on_done(file_path, done)
+
+    if prepare is None:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(work, path) for path in file_paths]
+            for future in futures:
+                future.result()
+        return done
+
+    # prepare thread -> bounded queue -> workers; put() blocking is the backpressure
+    ready = queue.Queue(maxsize=max(1, lookahead))
+    errors = []
+
+    def feed():
+        for path in file_paths:
+            if errors or not running():
+                break
+            prepare_quietly(prepare, path)
+            ready.put(path)
+        for _ in range(jobs):
+            ready.put(None)
+
+    def worker():
+        # Keep draining after an error so the feeder never blocks on a full queue
+        while (path := ready.get()) is not None:
+            if errors:
+                continue
+            try:
+                work(path)
+            except Exception as e:
+                errors.append(e)
+
+    with ThreadPoolExecutor(max_workers=jobs + 1) as executor:
+        futures = [executor.submit(feed)] + [executor.submit(worker) for _ in range(jobs)]
+        for future in futures:
+            future.result()
+    if errors:
+        raise errors[0]
+    return done
+
+
+class WorkerPool:
+    """Long-running counterpart of run_pool for files that arrive over time.
+
+    A path that is already queued or running is not submitted twice. With
+    prepare, files are prepared on their own thread before they are handed
+    to the workers, with at most `lookahead` prepared files waiting.
+    """
+
+    def __init__(self, process, jobs=1, on_error=None, prepare=None, lookahead=LOOKAHEAD):
+        self.process = process
+        self.prepare = prepare
+        self.threads = threads_per_job(jobs)
+        self.on_error = on_error
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self.preparer = ThreadPoolExecutor(max_workers=1)
+        self.slots = threading.Semaphore(max(1, jobs) + max(1, lookahead))
+
+    def submit(self, file_path):
+        """Queues a file. Returns a Future of process()'s result, or None if it is already queued or running."""
+        with self.lock:
+            if file_path in self.in_flight:
+                return None
+            self.in_flight.add(file_path)
+        future = Future()
+        if self.prepare is None:
+            self.executor.submit(self.work, file_path, future)
+        else:
+            self.preparer.submit(self.prepare_and_queue, file_path, future)
+        return future
+
+    def prepare_and_queue(self, file_path, future):
+        self.slots.acquire()
+        prepare_quietly(self.prepare, file_path)
+        self.executor.submit(self.work, file_path, future)
+
+    def work(self, file_path, future):
+        if not future.set_running_or_notify_cancel():
+            self.finish(file_path)
+            return
+        try:
+            future.set_result(self.process(file_path, self.threads))
+        except Exception as e:
+            future.set_exception(e)
+            if self.on_error is not None:
+                self.on_error(file_path, e)
+        finally:
+            self.finish(file_path)
+
+    def finish(self, file_path):
+        with self.lock:
+            self.in_flight.discard(file_path)
+        if self.prepare is not None:
+            self.slots.release()
+
+    def shutdown(self, wait=True):
+        self.preparer.shutdown(wait=wait)
+        self.executor.shutdown(wait=wait)
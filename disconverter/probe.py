@@ -0,0 +1,175 @@
+"""One ffprobe call per file, returning everything later stages need."""
+import json
+import subprocess
+from dataclasses import asdict, dataclass, field
+
+from . import metrics
+from .ffmpeg import spawn, wait
+
+# Packets from the start of the file used to estimate the keyframe interval
+KEYFRAME_PROBE_SECONDS = 10
+DURATION_TOLERANCE = 1.0  # seconds an encode may differ from its source
+
+
+@dataclass
+class StreamInfo:
+    index: int
+    codec_type: str
+    codec_name: str = ""
+    bit_rate: int = None
+    width: int = None
+    height: int = None
+    fps: float = None
+    pix_fmt: str = None
+    sample_rate: int = None
+    channels: int = None
+    duration: float = None
+
+
+@dataclass
+class VideoInfo:
+    duration: float = None
+    bit_rate: int = None
+    size: int = None
+    format_name: str = ""
+    keyframe_interval: float = None
+    streams: list = field(default_factory=list)
+
+    @property
+    def video(self):
+        return next((s for s in self.streams if s.codec_type == "video"), None)
+
+    @property
+    def audio(self):
+        return next((s for s in self.streams if s.codec_type == "audio"), None)
+
+    @property
+    def codec(self):
+        return self.video.codec_name if self.video else ""
+
+    def to_json(self):
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        data["streams"] = [StreamInfo(**s) for s in data.get("streams", [])]
+        return cls(**data)
+
+
+def parse_fps(info):
+    """Parses the FPS from an ffprobe rate like "30000/1001"."""
+    if '/' in info:
+        num, den = info.split('/')
+        try:
+            return float(num) / float(den)
+        except (ValueError, ZeroDivisionError):
+            return 30.0  # Default FPS if parsing fails
+    return 30.0  # Default FPS if format is unexpected
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def keyframe_interval(packets, video_index):
+    """Returns the average spacing of the keyframes seen in the probed packets."""
+    times = [
+        to_float(p.get("pts_time")) for p in packets
+        if p.get("stream_index") == video_index and "K" in p.get("flags", "")
+    ]
+    times = sorted(t for t in times if t is not None)
+    if len(times) < 2:
+        return None
+    return (times[-1] - times[0]) / (len(times) - 1)
+
+
+def parse_probe(data):
+    """Builds a VideoInfo from ffprobe's JSON output."""
+    fmt = data.get("format", {})
+    streams = []
+    for s in data.get("streams", []):
+        video = s.get("codec_type") == "video"
+        streams.append(StreamInfo(
+            index=s.get("index", len(streams)),
+            codec_type=s.get("codec_type", ""),
+            codec_name=s.get("codec_name", ""),
+            bit_rate=to_int(s.get("bit_rate")),
+            width=to_int(s.get("width")),
+            height=to_int(s.get("height")),
+            fps=parse_fps(s.get("avg_frame_rate") or s.get("r_frame_rate", "")) if video else None,
+            pix_fmt=s.get("pix_fmt"),
+            sample_rate=to_int(s.get("sample_rate")),
+            channels=to_int(s.get("channels")),
+            duration=to_float(s.get("duration")),
+        ))
+    info = VideoInfo(
+        duration=to_float(fmt.get("duration")),
+        bit_rate=to_int(fmt.get("bit_rate")),
+        size=to_int(fmt.get("size")),
+        format_name=fmt.get("format_name", ""),
+        streams=streams,
+    )
+    if info.video:
+        info.keyframe_interval = keyframe_interval(data.get("packets", []), info.video.index)
+    return info
+
+
+def run_probe(file_path):
+    """Runs ffprobe once and returns a VideoInfo, or None if the file can't be read."""
+    cmd = [
+        "ffprobe", "-v", "error", "-of", "json",
+        "-show_format", "-show_streams",
+        "-show_entries", "packet=stream_index,pts_time,flags",
+        "-read_intervals", f"%+{KEYFRAME_PROBE_SECONDS}",
+        file_path
+    ]
+    with metrics.stage("probe", bytes_in=metrics.file_size(file_path)) as event:
+        process = spawn(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                        text=True)
+        output = process.stdout.read()
+        wait(process)
+        try:
+            data = json.loads(output)
+        except ValueError:
+            data = {}
+        if not data.get("streams"):
+            event["outcome"] = "unreadable"
+            return None
+    return parse_probe(data)
+
+
+def is_complete(file_path, duration=None):
+    """Returns True if an encode probes with a video stream and, given the source duration, is about as long.
+
+    An encode cut short, by a full disk for example, fails this before it
+    replaces anything.
+    """
+    info = run_probe(file_path)
+    if info is None or info.video is None:
+        return False
+    if duration and (info.duration is None or abs(info.duration - duration) > DURATION_TOLERANCE):
+        return False
+    return True
+
+
+def probe_video(file_path, index=None):
+    """Returns the VideoInfo for a file, reusing the copy cached in the index if unchanged."""
+    if index is not None:
+        info = index.get_probe(file_path)
+        if info is not None:
+            return info
+    info = run_probe(file_path)
+    if info is not None and index is not None:
+        index.set_probe(file_path, info)
+    return info
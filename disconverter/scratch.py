@@ -0,0 +1,150 @@
+"""Scratch space for intermediates, and admission control for it.
+
+Masters, compression attempts, chunk segments, planner samples and x264 pass
+logs are all written under one scratch directory, which can sit on a local
+NVMe disk or a tmpfs; only the finished master and Discord copy are moved to
+their destination. Each job gets its own workspace there, and a job only
+starts once its projected output fits the space that is free and not already
+promised to the jobs that are running. A job that wouldn't fit even with
+the disk to itself fails before it starts, rather than running into a full
+disk halfway through.
+"""
+import errno
+import os
+import re
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+TEMP_SUFFIX = ".temp.mp4"
+RESERVE_MB = 512  # always left free for everything else on the scratch disk
+POLL_SECONDS = 5  # other programs free space too, so waiting jobs recheck now and then
+WORKSPACE_PREFIX = "disconvert_job_"
+
+_current = threading.local()
+
+
+class NoSpace(Exception):
+    """Raised for a job whose projected output doesn't fit the scratch disk even with nothing else running."""
+
+
+def current():
+    """Returns the workspace of the job running on this thread, or None outside one."""
+    return getattr(_current, "directory", None)
+
+
+def mkdtemp(prefix="disconvert_"):
+    """tempfile.mkdtemp in the current workspace, or the system temp directory outside one."""
+    return tempfile.mkdtemp(prefix=prefix, dir=current())
+
+
+def directory_size(path):
+    total = 0
+    for folder, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(folder, name))
+            except OSError:
+                continue
+    return total
+
+
+def move_into_place(source, destination):
+    """Moves a finished file to destination, replacing what is there.
+
+    Across filesystems the file is copied next to destination first and then
+    renamed, so destination never holds a partial file; a copy cut short
+    leaves a *.temp.mp4 that the next run cleans up.
+    """
+    try:
+        os.replace(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    partial = destination + TEMP_SUFFIX
+    try:
+        shutil.copyfile(source, partial)
+        os.replace(partial, destination)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    os.remove(source)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Scratch:
+    """A scratch directory shared by the jobs of one engine, safe to use from several threads."""
+
+    def __init__(self, root=None, reserve_mb=RESERVE_MB):
+        self.root = root or tempfile.gettempdir()
+        self.reserve = reserve_mb * 1024 * 1024
+        self.condition = threading.Condition()
+        self.workspaces = {}  # path -> bytes reserved for it
+        os.makedirs(self.root, exist_ok=True)
+
+    def free_bytes(self):
+        return shutil.disk_usage(self.root).free
+
+    def available(self):
+        """Returns the free bytes not promised to a running job. Call with the condition held."""
+        outstanding = sum(max(reserved - directory_size(path), 0) for path, reserved in self.workspaces.items())
+        return self.free_bytes() - outstanding - self.reserve
+
+    @contextmanager
+    def job(self, needed, log=print):
+        """Waits until `needed` bytes fit, then yields a fresh workspace that is removed afterwards.
+
+        While the block runs, mkdtemp() on this thread creates its
+        directories in the workspace. Raises NoSpace for a job that doesn't
+        fit even with nothing else running, there is nothing to wait for.
+        """
+        with self.condition:
+            waiting = False
+            while self.workspaces and self.available() < needed:
+                if not waiting:
+                    log(f"Waiting for scratch space: {needed / (1024 * 1024):.0f} MB needed, "
+                        f"{max(self.available(), 0) / (1024 * 1024):.0f} MB available")
+                    waiting = True
+                self.condition.wait(POLL_SECONDS)
+            if self.available() < needed:
+                raise NoSpace(f"not enough scratch space in {self.root}: "
+                              f"{max(self.available(), 0) / (1024 * 1024):.0f} MB available, "
+                              f"about {needed / (1024 * 1024):.0f} MB needed")
+            path = tempfile.mkdtemp(prefix=f"{WORKSPACE_PREFIX}{os.getpid()}_", dir=self.root)
+            self.workspaces[path] = needed
+        previous = current()
+        _current.directory = path
+        try:
+            yield path
+        finally:
+            _current.directory = previous
+            shutil.rmtree(path, ignore_errors=True)
+            with self.condition:
+                del self.workspaces[path]
+                self.condition.notify_all()
+
+    def remove_stale(self):
+        """Deletes workspaces left behind by processes that are gone. Returns their names.
+
+        Windows has no cheap way to ask whether a pid is alive, so it is skipped there.
+        """
+        if os.name == "nt":
+            return []
+        removed = []
+        for name in os.listdir(self.root):
+            match = re.match(rf"{WORKSPACE_PREFIX}(\d+)_", name)
+            if match and int(match.group(1)) != os.getpid() and not process_alive(int(match.group(1))):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+                removed.append(name)
+        return removed
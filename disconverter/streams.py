@@ -0,0 +1,73 @@
+"""Decides per stream whether a video has to be transcoded, copied or only remuxed."""
+import os
+from dataclasses import dataclass
+
+from . import metrics
+from .compress import AUDIO_BITRATE_KBPS, audio_args
+from .ffmpeg import output_ok, run_ffmpeg
+from .probe import is_complete
+
+COPY_VIDEO_CODECS = ("h264",)
+COPY_PIX_FMTS = (None, "yuv420p", "yuvj420p")  # what browsers and Discord decode
+COPY_AUDIO_CODECS = ("aac",)
+# Containers Discord won't embed, matched against ffprobe's format_name
+REMUX_FORMATS = ("matroska", "avi", "flv")
+
+
+@dataclass
+class StreamPlan:
+    copy_video: bool
+    copy_audio: bool
+    remux: bool  # compatible streams in an unwanted container
+
+    @property
+    def skip(self):
+        """True if the file is fine as it is."""
+        return self.copy_video and not self.remux
+
+
+def video_compatible(stream):
+    return stream is not None and stream.codec_name in COPY_VIDEO_CODECS and stream.pix_fmt in COPY_PIX_FMTS
+
+
+def audio_compatible(stream, max_kbps=AUDIO_BITRATE_KBPS):
+    """AAC at or under max_kbps can be copied as is; no audio at all needs nothing either."""
+    if stream is None:
+        return True
+    return (stream.codec_name in COPY_AUDIO_CODECS
+            and stream.bit_rate is not None and stream.bit_rate <= max_kbps * 1000)
+
+
+def plan_streams(info):
+    """Returns the StreamPlan for a probed file. Unknown files are transcoded."""
+    if info is None:
+        return StreamPlan(copy_video=False, copy_audio=False, remux=False)
+    copy_video = video_compatible(info.video)
+    remux = copy_video and any(name in info.format_name.split(",") for name in REMUX_FORMATS)
+    return StreamPlan(copy_video=copy_video, copy_audio=audio_compatible(info.audio), remux=remux)
+
+
+def remux_to_mp4(input_file, output_file, copy_audio=True, duration=None):
+    """Moves the first video and audio streams into a faststart MP4 without touching the video.
+
+    Returns True only if ffmpeg succeeded and the MP4 probes with its video
+    stream at the source's duration; otherwise the MP4 is removed, since the
+    caller deletes the source on success.
+    """
+    with metrics.stage("reencode", method="remux", bytes_in=metrics.file_size(input_file)) as event:
+        returncode = run_ffmpeg([
+            "-i", input_file, "-map", "0:v:0", "-map", "0:a:0?",
+            "-c:v", "copy", *audio_args(copy_audio), "-movflags", "+faststart", output_file
+        ])
+        done = output_ok(returncode, output_file)
+        if done and not is_complete(output_file, duration):
+            os.remove(output_file)
+            done = False
+        metrics.set_output(event, output_file)
+    return done
+
+
+def remuxed_path(file_path):
+    """Returns the .mp4 name a remuxed file gets, or None if that name is taken."""
+    target = os.path.splitext(file_path)[0] + ".mp4"
+    return None if os.path.exists(target) else target
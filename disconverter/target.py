@@ -0,0 +1,113 @@
+"""Plans the resolution, frame rate and bitrates a size cap can afford.
+
+The video budget is spread over width * height * fps; when that leaves too few
+bits per pixel for x264 to look any good, the frame rate is capped and the
+picture scaled down a step at a time until it does, so one encode fits instead
+of raising CRF until the picture falls apart. Long clips whose budget doesn't
+even cover the audio get a lower audio bitrate first.
+"""
+from dataclasses import dataclass
+
+AUDIO_BITRATE_KBPS = 128
+AUDIO_LADDER_KBPS = (AUDIO_BITRATE_KBPS, 96, 64)
+CONTAINER_OVERHEAD = 0.03  # mp4 muxing overhead, as a share of the budget
+MIN_VIDEO_BITRATE_KBPS = 64  # below this two-pass output is unwatchable anyway
+MIN_BITS_PER_PIXEL = 0.05  # x264 slow turns to mush below roughly this
+MAX_FPS = 30
+HEIGHTS = (1080, 720, 540, 480, 360, 240)
+DEFAULT_FPS = 30.0
+
+
+def target_video_bitrate(duration, max_size_mb, audio_kbps=AUDIO_BITRATE_KBPS):
+    """Returns the video bitrate in kbit/s that fits max_size_mb, or None if it can't."""
+    if not duration:
+        return None
+    budget_kbits = max_size_mb * 1024 * 1024 * 8 / 1000 * (1 - CONTAINER_OVERHEAD)
+    video_kbps = int(budget_kbits / duration - audio_kbps)
+    if video_kbps < MIN_VIDEO_BITRATE_KBPS:
+        return None
+    return video_kbps
+
+
+def bits_per_pixel(video_kbps, width, height, fps):
+    return video_kbps * 1000 / (width * height * fps)
+
+
+@dataclass
+class Target:
+    video_kbps: int = None  # None when the duration is unknown or the budget can't fit
+    audio_kbps: int = AUDIO_BITRATE_KBPS
+    height: int = None  # None keeps the source resolution
+    fps: float = None  # None keeps the source frame rate
+    copy_audio: bool = False
+    bpp: float = None
+
+    @property
+    def adjusted(self):
+        return bool(self.height or self.fps or self.audio_kbps != AUDIO_BITRATE_KBPS)
+
+    def video_args(self):
+        """Returns the scale and frame rate options for the video stream."""
+        args = []
+        if self.height:
+            args += ["-vf", f"scale=-2:{self.height}"]
+        if self.fps:
+            args += ["-r", f"{self.fps:g}"]
+        return args
+
+    def audio_args(self):
+        if self.copy_audio:
+            return ["-c:a", "copy"]
+        return ["-c:a", "aac", "-b:a", f"{self.audio_kbps}k"]
+
+    def describe(self):
+        parts = [f"{self.video_kbps}k video" if self.video_kbps else "CRF video"]
+        if self.height:
+            parts.append(f"scaled to {self.height}p")
+        if self.fps:
+            parts.append(f"{self.fps:g} fps")
+        parts.append("copied audio" if self.copy_audio else f"{self.audio_kbps}k audio")
+        if self.bpp:
+            parts.append(f"{self.bpp:.3f} bits/pixel")
+        return ", ".join(parts)
+
+
+def frame_candidates(height, fps):
+    """Returns (height, fps) pairs from the source's own down to the smallest step."""
+    capped = min(fps, MAX_FPS)
+    candidates = [(height, fps)]
+    if capped < fps:
+        candidates.append((height, capped))
+    candidates += [(h, capped) for h in HEIGHTS if h < height]
+    return candidates
+
+
+def plan_target(info, max_size_mb, copy_audio=False):
+    """Returns the Target for fitting a probed video (a VideoInfo, or None) under max_size_mb."""
+    duration = info.duration if info else None
+    if not duration:
+        return Target(copy_audio=copy_audio)
+
+    for audio_kbps in AUDIO_LADDER_KBPS:
+        video_kbps = target_video_bitrate(duration, max_size_mb, audio_kbps)
+        if video_kbps:
+            break
+    # With no bitrate that fits, CRF takes over at the lowest audio rate and resolution
+    target = Target(video_kbps, audio_kbps, copy_audio=copy_audio and audio_kbps == AUDIO_BITRATE_KBPS)
+
+    video = info.video
+    if not video or not video.width or not video.height:
+        return target
+    fps = video.fps or DEFAULT_FPS
+    for height, rate in frame_candidates(video.height, fps):
+        if not video_kbps:
+            continue
+        width = video.width * height / video.height
+        target.bpp = bits_per_pixel(video_kbps, width, height, rate)
+        if target.bpp >= MIN_BITS_PER_PIXEL:
+            break
+    if height != video.height:
+        target.height = height
+    if rate != fps:
+        target.fps = rate
+    return target
@@ -0,0 +1,158 @@
+"""Watches the source folder and yields new or changed videos once they settle.
+
+Uses inotify on Linux and falls back to polling the folder's directory
+entries elsewhere. Either way only files that changed are looked at again,
+and a file is only handed out once its size and mtime have stayed the same
+for settle_seconds, so videos that are still being written are left alone.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+
+# Intermediate files the pipeline writes next to the sources
+IGNORED_SUFFIXES = (".temp.mp4",)
+
+
+class InotifyBackend:
+    """Reports changed file names using the Linux inotify API."""
+
+    def __init__(self, directory):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def wait(self, timeout):
+        """Returns the names changed within timeout seconds."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        names = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingBackend:
+    """Reports changed file names by comparing directory entry stats between polls."""
+
+    def __init__(self, directory, interval=2.0):
+        self.directory = directory
+        self.interval = interval
+        self.seen = self.snapshot()
+
+    def snapshot(self):
+        entries = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        st = entry.stat()
+                        entries[entry.name] = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue
+        return entries
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        current = self.snapshot()
+        changed = {name for name, key in current.items() if self.seen.get(name) != key}
+        self.seen = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class FolderWatcher:
+    """Yields videos from one folder as they arrive or change."""
+
+    def __init__(self, directory, extensions, settle_seconds=3.0, initial_scan=True):
+        self.directory = directory
+        self.extensions = extensions
+        self.settle_seconds = settle_seconds
+        self.running = True
+        self.pending = {}  # name -> ((size, mtime_ns), time it was last seen changing)
+        try:
+            self.backend = InotifyBackend(directory)
+        except (OSError, AttributeError):
+            self.backend = PollingBackend(directory)
+        if initial_scan:
+            now = time.monotonic()
+            for name in os.listdir(directory):
+                self.touch(name, now)
+
+    def wanted(self, name):
+        lower = name.lower()
+        return lower.endswith(self.extensions) and not lower.endswith(IGNORED_SUFFIXES)
+
+    def touch(self, name, now):
+        """Starts or restarts the settle timer of a changed file."""
+        if self.wanted(name):
+            self.pending[name] = (None, now)
+
+    def settled(self, now):
+        """Returns the pending files whose size and mtime haven't changed for settle_seconds."""
+        ready = []
+        for name, (key, stable_since) in list(self.pending.items()):
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[name]  # deleted or moved away before it settled
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current != key:
+                self.pending[name] = (current, now)
+            elif st.st_size > 0 and now - stable_since >= self.settle_seconds:
+                del self.pending[name]
+                ready.append(path)
+        return ready
+
+    def changes(self):
+        """Yields paths of new or changed videos once they have settled, until stop() is called."""
+        while self.running:
+            timeout = 0.5 if self.pending else 5.0
+            now = time.monotonic()
+            for name in self.backend.wait(timeout):
+                self.touch(name, now)
+            yield from self.settled(time.monotonic())
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.backend.close()
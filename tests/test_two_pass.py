@@ -0,0 +1,36 @@
+"""Smoke tests for the two-pass encodes, against the real ffmpeg."""
+import shutil
+import subprocess
+
+import pytest
+
+from disconverter import compress
+from disconverter.probe import is_complete
+
+pytestmark = pytest.mark.skipif(not (shutil.which("ffmpeg") and shutil.which("ffprobe")),
+                                reason="needs ffmpeg and ffprobe")
+
+DURATION = 3
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source.mkv"
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-f", "lavfi", "-i", f"testsrc=duration={DURATION}:size=320x240:rate=25",
+        "-f", "lavfi", "-i", f"sine=duration={DURATION}", "-c:v", "libx264", "-c:a", "aac", str(path)
+    ], check=True)
+    return str(path)
+
+
+def test_two_pass(source, tmp_path):
+    output = str(tmp_path / "discord.mp4")
+    assert compress.encode_two_pass(source, output, 200) == 0
+    assert is_complete(output, DURATION)
+
+
+def test_fused_two_pass(source, tmp_path):
+    master, output = str(tmp_path / "master.mp4"), str(tmp_path / "discord.mp4")
+    assert compress.encode_fused(source, master, output, 200) == (True, True)
+    assert is_complete(master, DURATION)
+    assert is_complete(output, DURATION)